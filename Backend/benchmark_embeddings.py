@@ -0,0 +1,86 @@
+# Compares the embedding backends in embeddings.py on the food_facts collection.
+#
+#   python benchmark_embeddings.py [--onnx-dir models/all-MiniLM-L6-v2-int8]
+#                                  [--queries ingredients.txt] [--docs 200]
+#
+# Accuracy: cosine similarity between the PyTorch and ONNX vectors of the same
+# texts, and how often both return the same top-1 food_facts match for an
+# ingredient query. Latency: median time to embed batches of 1, 8 and 32.
+
+import argparse
+import statistics
+import time
+
+import chromadb
+import numpy as np
+
+from embeddings import DEFAULT_MODEL, DEFAULT_ONNX_DIR, HuggingFaceBackend, OnnxBackend
+
+DEFAULT_QUERIES = [
+    "rice", "white rice 150g", "fried rice", "chicken breast 80g", "fried chicken",
+    "egg", "boiled egg 50g", "santan", "coconut milk 100ml", "sambal", "anchovies",
+    "peanuts 20g", "cucumber", "beef rendang", "noodles", "soy sauce 10ml",
+    "white bread 2 slices", "butter 10g", "milk 200ml", "sugar 5g", "teh tarik",
+    "roti canai", "banana", "apple", "salmon 100g", "tofu", "tempeh", "broccoli",
+    "potato 150g", "cheddar cheese 20g", "chocolate", "cream cheese", "orange juice 250ml",
+]
+
+
+def median_ms(fn, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the embedding backends on food_facts")
+    parser.add_argument("--store", default="chroma_store")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--onnx-dir", default=DEFAULT_ONNX_DIR)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--queries", help="file with one ingredient per line")
+    parser.add_argument("--docs", type=int, default=200, help="food_facts documents to compare")
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    collection = chromadb.PersistentClient(path=args.store).get_collection("food_facts")
+    documents = collection.get(limit=args.docs, include=["documents"])["documents"]
+
+    backends = [HuggingFaceBackend(args.model), OnnxBackend(args.onnx_dir, threads=args.threads)]
+    reference, candidate = backends
+
+    # Accuracy
+    texts = queries + documents
+    a = np.asarray(reference.embed_documents(texts))
+    b = np.asarray(candidate.embed_documents(texts))
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    print(f"Cosine similarity, {candidate.name} vs {reference.name} ({len(texts)} texts): "
+          f"mean {cosine.mean():.4f}, min {cosine.min():.4f}")
+
+    top1 = []
+    for backend in backends:
+        results = collection.query(
+            query_embeddings=backend.embed_documents(queries), n_results=1, include=[]
+        )
+        top1.append([ids[0] if ids else None for ids in results["ids"]])
+    agreement = sum(x == y for x, y in zip(*top1)) / len(queries)
+    print(f"Top-1 food_facts match agreement ({len(queries)} queries): {agreement:.1%}")
+
+    # Latency
+    print(f"\n{'batch':>5}  " + "  ".join(f"{backend.name:>12}" for backend in backends) + "  (median ms)")
+    for batch_size in (1, 8, 32):
+        batch = (queries * (batch_size // len(queries) + 1))[:batch_size]
+        row = [median_ms(lambda: backend.embed_documents(batch), args.repeats) for backend in backends]
+        print(f"{batch_size:>5}  " + "  ".join(f"{ms:>12.1f}" for ms in row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Gemini chat sessions for the patient assistant (/chat), one per patient.
+#
+# Every message carries the persona and the patient's context, and may carry a
+# photo, so a session's history grows fast. After each message the history is
+# trimmed, oldest exchange first, to at most max_turns exchanges and max_tokens
+# estimated tokens. Sessions idle for longer than idle_seconds are dropped,
+# and beyond max_sessions or max_bytes of history (photos included) the least
+# recently used ones are dropped. Each request's context therefore stays small
+# and one patient's history never reaches another's prompt.
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+from conversation_memory import CHARS_PER_TOKEN
+
+IMAGE_TOKENS = 258  # what Gemini bills for an image up to 384x384
+
+
+def content_size(content) -> int:
+    """Approximate bytes held by one history entry: its text plus inline data."""
+    size = 0
+    for part in getattr(content, "parts", []):
+        size += len(getattr(part, "text", "") or "")
+        inline_data = getattr(part, "inline_data", None)
+        size += len(getattr(inline_data, "data", b"") or b"")
+    return size
+
+
+def content_tokens(content) -> int:
+    tokens = 0
+    for part in getattr(content, "parts", []):
+        tokens += len(getattr(part, "text", "") or "") // CHARS_PER_TOKEN
+        if getattr(getattr(part, "inline_data", None), "data", None):
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+class _Session:
+    def __init__(self):
+        self.chat = None  # started by the first message, under `lock`
+        self.size = 0
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+
+class ChatSessionManager:
+    def __init__(
+        self,
+        start_chat: Callable[[List[Any]], Any],
+        max_turns: int = 10,
+        max_tokens: int = 8000,
+        idle_seconds: float = 1800,
+        max_sessions: int = 1000,
+        max_bytes: int = 256 * 1024 * 1024,
+    ):
+        self.start_chat = start_chat
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sessions: "OrderedDict[Any, _Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _session(self, key) -> _Session:
+        # Only the map is updated under the manager's lock; the chat itself is
+        # started by _chat under the session's own lock, so starting one
+        # patient's session never holds up the others
+        with self._lock:
+            self._evict_idle()
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = _Session()
+            session.last_used = time.time()
+            self._sessions.move_to_end(key)
+            return session
+
+    def _chat(self, session: _Session):
+        """The session's chat, started on first use. Call with session.lock held."""
+        if session.chat is None:
+            session.chat = self.start_chat([])
+        return session.chat
+
+    def _evict_idle(self):
+        cutoff = time.time() - self.idle_seconds
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if session.last_used > cutoff:
+                break
+            del self._sessions[key]
+
+    def _evict_over_limits(self):
+        total = sum(session.size for session in self._sessions.values())
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_sessions or total > self.max_bytes
+        ):
+            _, session = self._sessions.popitem(last=False)
+            total -= session.size
+
+    def _trim(self, session: _Session):
+        # send_message appends a (user, model) pair per exchange, so dropping
+        # pairs from the front keeps the history starting with a user turn
+        history = list(session.chat.history)
+        tokens = sum(content_tokens(content) for content in history)
+        drop = 0
+        while len(history) - drop > 2 and (
+            len(history) - drop > 2 * self.max_turns or tokens > self.max_tokens
+        ):
+            tokens -= content_tokens(history[drop]) + content_tokens(history[drop + 1])
+            drop += 2
+        if drop:
+            session.chat.history = history[drop:]
+        session.size = sum(content_size(content) for content in history[drop:])
+
+    def send(self, key, content_parts):
+        """Send a message in `key`'s session and return Gemini's response.
+        Blocking; messages for one session are sent one at a time."""
+        session = self._session(key)
+        with session.lock:
+            response = self._chat(session).send_message(content_parts)
+            self._trim(session)
+        with self._lock:
+            self._evict_over_limits()
+        return response
+
+    def stream(self, key, content_parts):
+        """Like send, but a generator of response chunks as Gemini produces
+        them. If it fails or is closed early, the unfinished exchange is taken
+        back out of the history."""
+        session = self._session(key)
+        with session.lock:
+            history = list(self._chat(session).history)
+            try:
+                for chunk in session.chat.send_message(content_parts, stream=True):
+                    yield chunk
+                self._trim(session)
+            except BaseException:
+                session.chat.history = history
+                raise
+        with self._lock:
+            self._evict_over_limits()
+
+    def reset(self, key: Optional[Any] = None):
+        """Forget `key`'s session, or every session if key is None."""
+        with self._lock:
+            if key is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(key, None)
+
+    def __len__(self):
+        return len(self._sessions)
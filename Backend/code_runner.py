@@ -0,0 +1,311 @@
+# Runs the analytics code that /chat_bot_dr gets from OpenAI in a pool of worker
+# processes instead of inside the API process.
+#
+# Workers are spawned, not forked (the API process runs Firebase listener and
+# HTTP threads), and import pandas, numpy and matplotlib once when they start.
+# This module is all they import: main.py, and with it Firebase and the AI
+# clients, stays in the API process. The caller loads the tables the code asks
+# for (one doctor-scoped snapshot per request) and sends them along, and
+# final_answer comes back pickled.
+#
+# Charts are drawn with the Agg backend and rendered to PNG bytes in memory
+# from the figure the code leaves behind, then every figure is closed, so
+# concurrent questions never share a graph.png and workers don't accumulate
+# figures. Each worker also starts in a private temporary directory, so a
+# stray plt.savefig("graph.png") can't clobber another run's chart either.
+# Workers draw one throwaway chart when they start, so the font cache and the
+# renderer are loaded before the first question.
+#
+# Every run is limited three ways:
+#   - CPU time: RLIMIT_CPU is raised by the budget for each run, and SIGXCPU
+#     is turned into an exception
+#   - memory: RLIMIT_AS caps each worker; allocations beyond it raise MemoryError
+#   - wall clock: a timer in the worker interrupts Python code, and a worker
+#     stuck in C code past a grace period is killed along with its pool, which
+#     is then replaced. At most `workers` runs are submitted at a time, and a
+#     new pool's workers are started before any run is, so the parent's clock
+#     starts when the worker does: a run waiting for a worker never times out.
+# RLIMIT_* and the timer are POSIX only; on Windows just the pool-level
+# wall-clock timeout applies.
+
+import ast
+import functools
+import importlib
+import io
+import math
+import os
+import pickle
+import signal
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PRELOAD_MODULES = ("numpy", "pandas", "matplotlib", "matplotlib.pyplot")
+KILL_GRACE_SECONDS = 5.0
+GRAPH_DPI = 100
+
+_workdir: Optional[str] = None  # the worker's private working directory
+
+
+class RunLimitExceeded(Exception):
+    pass
+
+
+# ——— Worker side ———
+def _raise_cpu_limit(signum, frame):
+    raise RunLimitExceeded("CPU time limit exceeded")
+
+
+def _raise_timeout(signum, frame):
+    raise RunLimitExceeded("time limit exceeded")
+
+
+def _warm_render():
+    pyplot = sys.modules.get("matplotlib.pyplot")
+    if pyplot is None:
+        return
+    figure, axes = pyplot.subplots()
+    axes.plot([0, 1], [0, 1], label="warm-up")
+    axes.set_title("warm-up")
+    axes.legend()
+    figure.savefig(io.BytesIO(), format="png", dpi=GRAPH_DPI)
+    pyplot.close(figure)
+
+
+def _init_worker(memory_mb: int, preload: Tuple[str, ...], warm_render: bool):
+    # One BLAS/OpenMP thread per worker: the pool already runs code in parallel,
+    # and every extra thread reserves address space under RLIMIT_AS
+    for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ.setdefault(var, "1")
+    os.environ["MPLBACKEND"] = "Agg"
+    global _workdir
+    _workdir = tempfile.mkdtemp(prefix="code-runner-")
+    os.chdir(_workdir)
+    for module in preload:
+        importlib.import_module(module)
+    pandas = sys.modules.get("pandas")
+    if pandas is not None:
+        # Lets _get_df hand out views of the snapshot (see below)
+        pandas.set_option("mode.copy_on_write", True)
+    if warm_render:
+        _warm_render()
+
+    if resource is None:
+        return
+    signal.signal(signal.SIGXCPU, _raise_cpu_limit)
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    if memory_mb > 0:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = memory_mb * 1024 * 1024
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _cpu_used() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _set_run_limits(cpu_seconds: float, timeout: float):
+    if resource is None:
+        return
+    if cpu_seconds > 0:
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        soft = math.ceil(_cpu_used() + cpu_seconds)
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+    if timeout > 0:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+
+
+def _clear_run_limits():
+    if resource is None:
+        return
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+
+def _get_df(tables: Dict[str, Any], table_name: str, dr_id=None):
+    # The tables were loaded for the requesting doctor before the run; dr_id is
+    # accepted because the generated code passes it, but cannot widen that.
+    # Under copy-on-write a shallow copy shares the snapshot's data and only
+    # copies a column when the code modifies it, so every call is zero-copy and
+    # the snapshot stays as it was for the next get_df.
+    if table_name not in tables:
+        raise KeyError(f"Unknown table: {table_name}")
+    return tables[table_name].copy(deep=False)
+
+
+def _picklable(value):
+    try:
+        pickle.dumps(value)
+        return value
+    except Exception:
+        return repr(value)
+
+
+def _render_graph(final_graph) -> Optional[bytes]:
+    """PNG bytes of the chart the code drew. final_graph is usually the pyplot
+    module itself (meaning the current figure), but may be a Figure or Axes."""
+    pyplot = sys.modules.get("matplotlib.pyplot")
+    if pyplot is None:
+        return None
+    if isinstance(final_graph, pyplot.Figure):
+        figure = final_graph
+    elif isinstance(getattr(final_graph, "figure", None), pyplot.Figure):
+        figure = final_graph.figure
+    elif pyplot.get_fignums():
+        figure = pyplot.gcf()
+    else:
+        return None
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png", dpi=GRAPH_DPI, bbox_inches="tight")
+    return buffer.getvalue()
+
+
+def _cleanup():
+    pyplot = sys.modules.get("matplotlib.pyplot")
+    if pyplot is not None:
+        pyplot.close("all")
+    # Files the code wrote anyway (graph.png, CSVs) are private to this worker
+    if _workdir is not None:
+        os.chdir(_workdir)
+        for name in os.listdir(_workdir):
+            try:
+                os.remove(os.path.join(_workdir, name))
+            except OSError:
+                pass
+
+
+def _run(code: str, tables: Dict[str, Any], cpu_seconds: float, timeout: float):
+    namespace = {"get_df": functools.partial(_get_df, tables)}
+    graph = None
+    try:
+        _set_run_limits(cpu_seconds, timeout)
+        try:
+            exec(code, namespace)
+            if "final_answer" not in namespace:
+                return None, None, "final_answer was not set"
+            if namespace.get("final_graph") is not None:
+                graph = _render_graph(namespace["final_graph"])
+        finally:
+            _clear_run_limits()
+    except MemoryError:
+        return None, None, "memory limit exceeded"
+    except RunLimitExceeded as e:
+        return None, None, str(e)
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+    finally:
+        _cleanup()
+
+    return _picklable(namespace["final_answer"]), graph, None
+
+
+def _ping():
+    return os.getpid()
+
+
+# ——— API side ———
+def requested_tables(code: str, known_tables: Iterable[str]) -> Set[str]:
+    """Tables the code passes to get_df. Any call with a computed table name
+    means all of `known_tables`."""
+    known_tables = set(known_tables)
+    tables = set()
+    for node in ast.walk(ast.parse(code)):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                and node.func.id == "get_df"):
+            continue
+        arg = node.args[0] if node.args else next(
+            (kw.value for kw in node.keywords if kw.arg == "table_name"), None)
+        if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+            tables.add(arg.value)
+        else:
+            return tables | known_tables
+    return tables
+
+
+class CodeRunner:
+    def __init__(self, workers: int = 2, cpu_seconds: float = 20, memory_mb: int = 2048,
+                 timeout: float = 30, preload: Tuple[str, ...] = PRELOAD_MODULES,
+                 warm_render: bool = True):
+        self.workers = workers
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.timeout = timeout
+        self.preload = preload
+        self.warm_render = warm_render
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.memory_mb, self.preload, self.warm_render),
+                )
+                # Start every worker (pandas and matplotlib imports) here rather
+                # than on the clock of the first runs
+                try:
+                    for future in [executor.submit(_ping) for _ in range(self.workers)]:
+                        future.result()
+                except BaseException:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+                self._executor = executor
+            return self._executor
+
+    def _replace(self, executor: ProcessPoolExecutor):
+        """Kill `executor`'s workers (a stuck one cannot be interrupted any other
+        way) and let the next run start a fresh pool. Runs still in flight on
+        it fail with BrokenProcessPool."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def warm_up(self):
+        """Start every worker now, so the first question doesn't wait for the
+        pandas and matplotlib imports."""
+        self._pool()
+
+    def run(self, code: str, tables: Dict[str, Any]) -> Tuple[Any, Optional[bytes], Optional[str]]:
+        """Execute `code` with get_df serving `tables`. Blocks until it is done.
+        Returns (final_answer, graph_png, error); graph_png is None without a
+        chart, and error is None on success. Waits for a free worker first,
+        so the timeout only counts time the code actually runs."""
+        with self._slots:
+            executor = self._pool()
+            future = executor.submit(_run, code, tables, self.cpu_seconds, self.timeout)
+            try:
+                return future.result(timeout=self.timeout + KILL_GRACE_SECONDS)
+            except FutureTimeoutError:
+                self._replace(executor)
+                return None, None, "time limit exceeded"
+            except BrokenProcessPool:
+                self._replace(executor)
+                return None, None, "worker process died"
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
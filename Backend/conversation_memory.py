@@ -0,0 +1,226 @@
+# Conversation memory for the doctor assistant (/chat_bot_dr).
+#
+# Each conversation is keyed by doctor and session and holds a rolling summary
+# plus the most recent question/answer turns. Whenever the conversation goes
+# over its token budget, the oldest turns are folded into the summary by a
+# caller-supplied summarize(summary, turns) function (an LLM call in main.py),
+# so the history put into every prompt stays roughly constant in size however
+# long a doctor keeps asking. Tokens are estimated at four characters each,
+# which is close enough for a budget and needs no tokenizer.
+#
+# Storage is pluggable: InMemoryConversationStore keeps conversations in an LRU
+# dict (lost on restart), SqliteConversationStore keeps them in a SQLite file.
+# Select one with CHAT_MEMORY_BACKEND=memory|sqlite (see
+# conversation_memory_from_env).
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+Turn = Tuple[str, str]  # (question, answer)
+Conversation = Tuple[str, List[Turn]]  # (summary, turns)
+
+CHARS_PER_TOKEN = 4
+LOCK_STRIPES = 64
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def format_turns(turns: List[Turn]) -> str:
+    return "".join(
+        f"""
+        --------------------------
+        Question : {question}
+        Answer : {answer}
+        --------------------------
+        """
+        for question, answer in turns
+    )
+
+
+class ConversationStore(ABC):
+    @abstractmethod
+    def load(self, key: str) -> Conversation:
+        """The conversation stored under `key`, or ("", []) if there is none."""
+
+    @abstractmethod
+    def save(self, key: str, summary: str, turns: List[Turn]):
+        """Replace the conversation stored under `key`."""
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Forget `key`'s conversation, if there is one."""
+
+    def close(self):
+        pass
+
+
+class InMemoryConversationStore(ConversationStore):
+    def __init__(self, max_conversations: int = 1000):
+        self.max_conversations = max_conversations
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, key: str) -> Conversation:
+        with self._lock:
+            if key not in self._conversations:
+                return "", []
+            self._conversations.move_to_end(key)
+            summary, turns = self._conversations[key]
+            return summary, list(turns)
+
+    def save(self, key: str, summary: str, turns: List[Turn]):
+        with self._lock:
+            self._conversations[key] = (summary, list(turns))
+            self._conversations.move_to_end(key)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conversations.pop(key, None)
+
+
+class SqliteConversationStore(ConversationStore):
+    def __init__(self, path: str, max_age: float = 7 * 24 * 3600):
+        self.max_age = max_age
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " key TEXT PRIMARY KEY, summary TEXT NOT NULL, turns TEXT NOT NULL,"
+                " updated REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated)"
+            )
+
+    def load(self, key: str) -> Conversation:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, turns FROM conversations WHERE key = ? AND updated > ?",
+                (key, time.time() - self.max_age),
+            ).fetchone()
+        if row is None:
+            return "", []
+        return row[0], [tuple(turn) for turn in json.loads(row[1])]
+
+    def save(self, key: str, summary: str, turns: List[Turn]):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversations (key, summary, turns, updated) VALUES (?, ?, ?, ?)",
+                (key, summary, json.dumps(turns), now),
+            )
+            # Conversations nobody came back to
+            self._conn.execute("DELETE FROM conversations WHERE updated <= ?", (now - self.max_age,))
+
+    def delete(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM conversations WHERE key = ?", (key,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ConversationMemory:
+    def __init__(
+        self,
+        store: ConversationStore,
+        summarize: Callable[[str, List[Turn]], str],
+        token_budget: int = 2000,
+        keep_turns: int = 4,
+    ):
+        self.store = store
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        # Striped, so turns for one conversation are added one at a time without
+        # a lock per conversation ever created
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    @staticmethod
+    def key(dr_id: int, session_id: Optional[str] = None) -> str:
+        return f"{dr_id}:{session_id or 'default'}"
+
+    def _lock(self, key: str) -> threading.Lock:
+        return self._locks[hash(key) % LOCK_STRIPES]
+
+    def history(self, key: str) -> str:
+        """The conversation as prompt text: the summary of earlier turns, then
+        the recent turns verbatim."""
+        summary, turns = self.store.load(key)
+        text = format_turns(turns)
+        if summary:
+            text = f"\n        Summary of the earlier conversation : {summary}\n" + text
+        return text
+
+    def add_turn(self, key: str, question: str, answer: str):
+        """Append a turn, summarizing the oldest ones if that goes over the
+        budget. Blocking: summarizing is an LLM call."""
+        with self._lock(key):
+            summary, turns = self.store.load(key)
+            turns.append((question, answer))
+            if estimate_tokens(summary + format_turns(turns)) > self.token_budget:
+                summary, turns = self._compact(summary, turns)
+            self.store.save(key, summary, turns)
+
+    def _compact(self, summary: str, turns: List[Turn]) -> Conversation:
+        # Fold turns, oldest first, until the recent ones fit in a quarter of
+        # the budget. Half is for the summary, and the rest is headroom so the
+        # next few turns fit without another summary call.
+        split = 0
+        while split < len(turns) - self.keep_turns and (
+            estimate_tokens(format_turns(turns[split:])) > self.token_budget // 4
+        ):
+            split += 1
+        split = max(split, 1) if len(turns) > self.keep_turns else split
+        if split == 0:
+            return self._truncate(summary), turns
+
+        try:
+            summary = self.summarize(summary, turns[:split])
+        except Exception as e:
+            # The folded turns are dropped rather than kept over budget
+            print(f"Conversation summary failed: {e}")
+        return self._truncate(summary), turns[split:]
+
+    def _truncate(self, summary: str) -> str:
+        max_chars = self.token_budget // 2 * CHARS_PER_TOKEN
+        return summary if len(summary) <= max_chars else summary[-max_chars:]
+
+    def clear(self, key: str):
+        with self._lock(key):
+            self.store.delete(key)
+
+    def close(self):
+        self.store.close()
+
+
+def conversation_memory_from_env(summarize: Callable[[str, List[Turn]], str]) -> ConversationMemory:
+    kind = os.getenv("CHAT_MEMORY_BACKEND", "memory")
+    if kind == "memory":
+        store = InMemoryConversationStore(int(os.getenv("CHAT_MEMORY_MAX_CONVERSATIONS", "1000")))
+    elif kind == "sqlite":
+        store = SqliteConversationStore(
+            os.getenv("CHAT_MEMORY_PATH", "chat_memory.sqlite3"),
+            max_age=float(os.getenv("CHAT_MEMORY_MAX_AGE_SECONDS", "604800")),
+        )
+    else:
+        raise ValueError(f"Unknown CHAT_MEMORY_BACKEND: {kind}")
+    return ConversationMemory(
+        store,
+        summarize,
+        token_budget=int(os.getenv("CHAT_MEMORY_TOKEN_BUDGET", "2000")),
+        keep_turns=int(os.getenv("CHAT_MEMORY_KEEP_TURNS", "4")),
+    )
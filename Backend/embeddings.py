@@ -0,0 +1,164 @@
+# Embedding backends for the food_facts ingredient lookups.
+#
+# "huggingface" is the original sentence-transformers model on PyTorch.
+# "onnx" runs the same all-MiniLM-L6-v2 network, exported to ONNX and
+# int8-quantized, on ONNX Runtime: a fraction of the memory and faster on CPU.
+# It reproduces the sentence-transformers pipeline (mean pooling over the
+# attention mask, then L2 normalization), so its vectors live in the same space
+# as the ones already stored in chroma_store and no re-index is needed;
+# benchmark_embeddings.py measures how close they are.
+#
+# Create the quantized model once with:
+#   python embeddings.py export [--out models/all-MiniLM-L6-v2-int8]
+
+import argparse
+import os
+from abc import ABC, abstractmethod
+from typing import List
+
+import numpy as np
+
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+DEFAULT_ONNX_DIR = "models/all-MiniLM-L6-v2-int8"
+MAX_SEQ_LENGTH = 256  # same as the sentence-transformers model config
+
+
+class EmbeddingBackend(ABC):
+    name = "base"
+
+    @abstractmethod
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """One embedding per text."""
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class HuggingFaceBackend(EmbeddingBackend):
+    name = "huggingface"
+
+    def __init__(self, model_name: str = DEFAULT_MODEL):
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        self._model = HuggingFaceEmbeddings(model_name=model_name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._model.embed_query(text)
+
+
+class OnnxBackend(EmbeddingBackend):
+    name = "onnx"
+
+    def __init__(self, model_dir: str = DEFAULT_ONNX_DIR, threads: int = 0, batch_size: int = 32):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_path = os.path.join(model_dir, "model.onnx")
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"{model_path} not found, create it with: python embeddings.py export --out {model_dir}"
+            )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads  # 0 lets ONNX Runtime pick
+        options.inter_op_num_threads = 1
+        self._session = ort.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self._session.get_inputs()}
+
+        self._tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self._tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        self._tokenizer.enable_padding()
+        self.batch_size = batch_size
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self._tokenizer.encode_batch(texts)
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        feeds = {k: v for k, v in feeds.items() if k in self._input_names}
+        hidden = self._session.run(None, feeds)[0]  # (batch, tokens, 384)
+
+        mask = feeds["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled / np.clip(norms, 1e-12, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        batches = [
+            self._embed_batch(texts[i:i + self.batch_size])
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        return np.vstack(batches).tolist()
+
+
+def embedding_backend_from_env(model_name: str = DEFAULT_MODEL) -> EmbeddingBackend:
+    kind = os.getenv("EMBEDDING_BACKEND", "huggingface")
+    if kind == "huggingface":
+        return HuggingFaceBackend(model_name)
+    if kind == "onnx":
+        return OnnxBackend(
+            os.getenv("EMBEDDING_ONNX_DIR", DEFAULT_ONNX_DIR),
+            threads=int(os.getenv("EMBEDDING_THREADS", "0")),
+            batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "32")),
+        )
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {kind}")
+
+
+def export_quantized_model(model_name: str = DEFAULT_MODEL, out_dir: str = DEFAULT_ONNX_DIR):
+    """Export the transformer to ONNX and quantize its weights to int8.
+    Needs torch and transformers (installed with sentence-transformers)."""
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    sample = tokenizer(["grilled chicken 80g"], return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    fp32_path = os.path.join(out_dir, "model-fp32.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                **{name: {0: "batch", 1: "tokens"} for name in input_names},
+                "last_hidden_state": {0: "batch", 1: "tokens"},
+            },
+            opset_version=14,
+        )
+
+    quantize_dynamic(fp32_path, os.path.join(out_dir, "model.onnx"), weight_type=QuantType.QInt8)
+    os.remove(fp32_path)
+    tokenizer.save_pretrained(out_dir)  # writes tokenizer.json
+    print(f"Wrote int8 model and tokenizer to {out_dir}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Embedding backend tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="export and int8-quantize the ONNX model")
+    export_parser.add_argument("--model", default=DEFAULT_MODEL)
+    export_parser.add_argument("--out", default=DEFAULT_ONNX_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        export_quantized_model(args.model, args.out)
+
+
+if __name__ == "__main__":
+    main()
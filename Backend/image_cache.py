@@ -0,0 +1,152 @@
+# Cache of analysed food photos.
+#
+# Patients photograph the same meals over and over. Each analysis is stored
+# under the image's sha256 (exact repeats) and a 64-bit perceptual hash
+# (re-takes of the same plate), and a new photo whose perceptual hash is
+# within `max_distance` bits of a cached one reuses that result instead of
+# going through Gemini and Chroma again.
+#
+# Entries expire after `ttl` seconds and the least recently used ones are
+# evicted beyond `max_entries`. Results are kept per namespace (one per
+# endpoint and prompt), because the same photo gives different answers to
+# different prompts.
+
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import PIL.Image
+
+HASH_SIZE = 8
+PHASH_SAMPLE = 32
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+DCT_MATRIX = _dct_matrix(PHASH_SAMPLE)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def dhash(img: PIL.Image.Image) -> int:
+    """Difference hash: sign of the horizontal gradient on a 9x8 thumbnail."""
+    small = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), PIL.Image.LANCZOS)
+    pixels = np.asarray(small, dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(img: PIL.Image.Image) -> int:
+    """Perceptual hash: low DCT frequencies of a 32x32 thumbnail against their median."""
+    small = img.convert("L").resize((PHASH_SAMPLE, PHASH_SAMPLE), PIL.Image.LANCZOS)
+    pixels = np.asarray(small, dtype=np.float64)
+    low = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE]
+    median = np.median(low.ravel()[1:])  # the DC term would skew the median
+    return _bits_to_int(low > median)
+
+
+HASHES = {"phash": phash, "dhash": dhash}
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class CachedAnalysis:
+    def __init__(self, digest: str, perceptual: int, value: Dict[str, Any], expires: float):
+        self.digest = digest
+        self.perceptual = perceptual
+        self.value = value
+        self.expires = expires
+
+
+class ImageAnalysisCache:
+    def __init__(self, max_distance: int = 6, ttl: float = 7 * 24 * 3600,
+                 max_entries: int = 5000, hash_name: str = "phash"):
+        if hash_name not in HASHES:
+            raise ValueError(f"Unknown image hash: {hash_name}")
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hash = HASHES[hash_name]
+        # (namespace, sha256) -> entry, in LRU order
+        self._entries: "OrderedDict[Tuple[str, str], CachedAnalysis]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def fingerprint(self, data: bytes) -> Tuple[str, int]:
+        """(sha256, perceptual hash) of an encoded image."""
+        digest = hashlib.sha256(data).hexdigest()
+        with PIL.Image.open(io.BytesIO(data)) as img:
+            return digest, self.hash(img)
+
+    def lookup(self, namespace: str, data: bytes):
+        """Fingerprint `data` and look it up.
+        Returns (fingerprint, cached value or None); pass the fingerprint to put()."""
+        fingerprint = self.fingerprint(data)
+        return fingerprint, self.get(namespace, fingerprint)
+
+    def get(self, namespace: str, fingerprint: Tuple[str, int]) -> Optional[Dict[str, Any]]:
+        digest, perceptual = fingerprint
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((namespace, digest))
+            if entry is not None and entry.expires > now:
+                self._entries.move_to_end((namespace, digest))
+                self.hits += 1
+                return dict(entry.value)
+
+            best_key, best_distance = None, self.max_distance + 1
+            for key, entry in list(self._entries.items()):
+                if entry.expires <= now:
+                    del self._entries[key]
+                    continue
+                if key[0] != namespace:
+                    continue
+                distance = hamming(entry.perceptual, perceptual)
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.near_hits += 1
+            return dict(self._entries[best_key].value)
+
+    def put(self, namespace: str, fingerprint: Tuple[str, int], value: Dict[str, Any]):
+        digest, perceptual = fingerprint
+        with self._lock:
+            self._entries[(namespace, digest)] = CachedAnalysis(
+                digest, perceptual, dict(value), time.time() + self.ttl
+            )
+            self._entries.move_to_end((namespace, digest))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+            }
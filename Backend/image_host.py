@@ -0,0 +1,169 @@
+# Image hosting for uploaded meal photos and chatbot graphs.
+#
+# ImageHost.upload() stores the bytes somewhere reachable and returns a public
+# link. ImgurImageHost talks to the Imgur API through one shared httpx
+# AsyncClient, so connections (and their TLS sessions) are kept alive and
+# reused between uploads, every request has a timeout, and transient failures
+# (429, 5xx, and connection errors that happen before the upload is sent) are
+# retried a bounded number of times with exponential backoff. Errors after the
+# upload may have reached Imgur, such as read timeouts, are not retried, so an
+# image is never stored twice that way. LocalImageHost writes the files to a directory instead,
+# for running and testing without Imgur.
+#
+# Select one with IMAGE_HOST=imgur|local (see image_host_from_env).
+
+import asyncio
+import hashlib
+import os
+import random
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import httpx
+
+IMGUR_UPLOAD_ENDPOINT = "https://api.imgur.com/3/image"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Raised before any of the request was sent
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class ImageHostError(RuntimeError):
+    pass
+
+
+class ImageHost(ABC):
+    @abstractmethod
+    async def upload(self, data: bytes, filename: Optional[str] = None) -> str:
+        """Store `data` and return a link to it. Raises ImageHostError."""
+
+    async def aclose(self):
+        pass
+
+
+class ImgurImageHost(ImageHost):
+    def __init__(
+        self,
+        client_id: Optional[str],
+        endpoint: str = IMGUR_UPLOAD_ENDPOINT,
+        timeout: float = 15.0,
+        connect_timeout: float = 5.0,
+        max_retries: int = 2,
+        backoff: float = 0.5,
+        max_retry_delay: float = 10.0,
+        max_connections: int = 8,
+    ):
+        self.client_id = client_id
+        self.endpoint = endpoint
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_delay = max_retry_delay
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created on first use so it binds to the server's event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                headers={"Authorization": f"Client-ID {self.client_id}"},
+                timeout=self.timeout,
+                limits=self.limits,
+            )
+        return self._client
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response] = None) -> Optional[float]:
+        """Seconds to wait before the next attempt, or None if the server asks
+        for a longer wait than max_retry_delay."""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = float(retry_after)
+                return delay if delay <= self.max_retry_delay else None
+        # Exponential backoff with full jitter
+        return min(random.uniform(0, self.backoff * (2 ** attempt)), self.max_retry_delay)
+
+    async def upload(self, data: bytes, filename: Optional[str] = None) -> str:
+        if not self.client_id:
+            raise ImageHostError("IMGUR_CLIENT_ID is not set")
+
+        files = {"image": (filename or "image", data)}
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = await self.client.post(self.endpoint, files=files)
+            except httpx.TransportError as e:
+                if last_attempt or not isinstance(e, RETRY_ERRORS):
+                    raise ImageHostError(f"Imgur upload failed: {e!r}") from e
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+
+            if response.status_code in RETRY_STATUS and not last_attempt:
+                delay = self._retry_delay(attempt, response)
+                if delay is not None:
+                    await asyncio.sleep(delay)
+                    continue
+            if response.is_error:
+                raise ImageHostError(
+                    f"Imgur upload failed with status {response.status_code}: {response.text[:200]}"
+                )
+            try:
+                return response.json()["data"]["link"]
+            except (ValueError, KeyError, TypeError) as e:
+                raise ImageHostError(f"Unexpected Imgur response: {response.text[:200]}") from e
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class LocalImageHost(ImageHost):
+    """Writes uploads to `directory` and links to them under `base_url`.
+    Files are named by content hash, so re-uploading an image reuses its file."""
+
+    def __init__(self, directory: str, base_url: str):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(directory, exist_ok=True)
+
+    def _write(self, data: bytes, filename: Optional[str]) -> str:
+        extension = os.path.splitext(filename or "")[1].lower() or ".jpg"
+        name = hashlib.sha256(data).hexdigest()[:32] + extension
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return name
+
+    async def upload(self, data: bytes, filename: Optional[str] = None) -> str:
+        try:
+            name = await asyncio.to_thread(self._write, data, filename)
+        except OSError as e:
+            raise ImageHostError(f"Local image upload failed: {e}") from e
+        return f"{self.base_url}/{name}"
+
+
+def image_host_from_env() -> ImageHost:
+    kind = os.getenv("IMAGE_HOST", "imgur")
+    if kind == "local":
+        return LocalImageHost(
+            os.getenv("LOCAL_IMAGE_DIR", "uploaded_images"),
+            os.getenv("LOCAL_IMAGE_BASE_URL", "http://localhost:8000/images"),
+        )
+    if kind != "imgur":
+        raise ValueError(f"Unknown IMAGE_HOST: {kind}")
+    return ImgurImageHost(
+        os.getenv("IMGUR_CLIENT_ID"),
+        timeout=float(os.getenv("IMGUR_TIMEOUT_SECONDS", "15")),
+        connect_timeout=float(os.getenv("IMGUR_CONNECT_TIMEOUT_SECONDS", "5")),
+        max_retries=int(os.getenv("IMGUR_MAX_RETRIES", "2")),
+        backoff=float(os.getenv("IMGUR_RETRY_BACKOFF_SECONDS", "0.5")),
+        max_retry_delay=float(os.getenv("IMGUR_MAX_RETRY_DELAY_SECONDS", "10")),
+        max_connections=int(os.getenv("IMGUR_MAX_CONNECTIONS", "8")),
+    )
@@ -0,0 +1,103 @@
+# Preprocessing for uploaded meal photos.
+#
+# Phone photos arrive at full resolution (often 4-12 MB). Neither Gemini nor the
+# image host needs that, so uploads are read in chunks up to a size cap, rotated
+# according to their EXIF orientation (the pixels are stored sideways otherwise
+# once the EXIF tag is dropped), downscaled to a maximum edge and re-encoded as
+# a compact JPEG or WebP. The same reduced bytes go to Gemini and the image host.
+
+import io
+import os
+from typing import Optional
+
+import PIL.Image
+from PIL import ImageOps
+
+READ_CHUNK_SIZE = 64 * 1024
+EXIF_ORIENTATION = 0x0112
+
+IMAGE_MAX_UPLOAD_BYTES = int(float(os.getenv("IMAGE_MAX_UPLOAD_MB", "15")) * 1024 * 1024)
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1280"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+}
+
+
+class ImageTooLargeError(ValueError):
+    pass
+
+
+class PreparedImage:
+    def __init__(self, data: bytes, mime_type: str, filename: str, size):
+        self.data = data
+        self.mime_type = mime_type
+        self.filename = filename
+        self.size = size  # (width, height) after preprocessing
+
+    def gemini_part(self):
+        """Inline image part for generate_content / send_message."""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+async def read_upload(file, max_bytes: int = IMAGE_MAX_UPLOAD_BYTES) -> bytes:
+    """Read an UploadFile in chunks, failing as soon as it exceeds max_bytes."""
+    if file.size is not None and file.size > max_bytes:
+        raise ImageTooLargeError(f"Image is larger than {max_bytes // (1024 * 1024)} MB")
+    buffer = io.BytesIO()
+    while True:
+        chunk = await file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer.write(chunk)
+        if buffer.tell() > max_bytes:
+            raise ImageTooLargeError(f"Image is larger than {max_bytes // (1024 * 1024)} MB")
+    return buffer.getvalue()
+
+
+def prepare_image(
+    contents: bytes,
+    filename: Optional[str] = None,
+    max_edge: int = IMAGE_MAX_EDGE,
+    image_format: str = IMAGE_FORMAT,
+    quality: int = IMAGE_QUALITY,
+) -> PreparedImage:
+    """Orient, downscale and re-encode an uploaded image.
+    Raises PIL.UnidentifiedImageError if the bytes are not an image."""
+    pil_format, mime_type, extension = FORMATS.get(image_format, FORMATS["jpeg"])
+    stem = os.path.splitext(filename or "image")[0]
+
+    img = PIL.Image.open(io.BytesIO(contents))
+    rotated = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+    oriented = ImageOps.exif_transpose(img) if rotated else img
+
+    needs_resize = max(oriented.size) > max_edge
+    if needs_resize:
+        oriented.thumbnail((max_edge, max_edge), PIL.Image.LANCZOS)
+
+    # Small, upright images already in the target format are sent as they are
+    if not needs_resize and not rotated and img.format == pil_format:
+        return PreparedImage(contents, mime_type, stem + extension, oriented.size)
+
+    if pil_format == "JPEG" and oriented.mode != "RGB":
+        if oriented.mode in ("RGBA", "LA", "P"):
+            # Flatten transparency onto white instead of black
+            rgba = oriented.convert("RGBA")
+            background = PIL.Image.new("RGB", rgba.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            oriented = background
+        else:
+            oriented = oriented.convert("RGB")
+
+    output = io.BytesIO()
+    oriented.save(output, format=pil_format, quality=quality, optimize=True)
+    data = output.getvalue()
+
+    # Re-encoding an already compact image can make it bigger
+    if not needs_resize and not rotated and len(data) >= len(contents):
+        return PreparedImage(contents, PIL.Image.MIME.get(img.format, mime_type),
+                             filename or stem + extension, oriented.size)
+    return PreparedImage(data, mime_type, stem + extension, oriented.size)
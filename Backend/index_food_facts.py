@@ -0,0 +1,157 @@
+# Maintains the per-100g nutrient metadata on the food_facts collection that the
+# local nutrient calculator (nutrition.py) reads.
+#
+#   python index_food_facts.py backfill [--dry-run]
+#       Parses calories, fat, sodium and sugar out of every document's text and
+#       stores them, scaled to 100 g, as metadata.
+#   python index_food_facts.py import-csv foods.csv
+#       Adds or replaces documents from a CSV with the columns
+#       name, kcal, fat_g, sodium_mg, sugar_g (all per 100 g).
+#
+# Both bump the collection's "nutrients_version", which invalidates persisted
+# ingredient caches (see ingredient_cache.py). Restart the API afterwards.
+
+import argparse
+import csv
+import re
+import sys
+import time
+from typing import Dict, Optional
+
+import chromadb
+
+from nutrition import parse_number
+
+PERSIST_DIRECTORY = "chroma_store"
+COLLECTION = "food_facts"
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+PAGE_SIZE = 500
+
+NUMBER = r"(\d+(?:[.,]\d+)*)"
+# metadata key -> (patterns tried in order, default unit when the text gives none).
+# Energy is often given in both units ("Energy 1046 kJ / 250 kcal"), so an
+# explicit kcal value wins over whatever number follows "energy".
+PATTERNS = {
+    "kcal_per_100g": (
+        [
+            re.compile(rf"{NUMBER}\s*(kcal)\b", re.I),
+            re.compile(rf"(?:calories|energy)\D{{0,15}}?{NUMBER}\s*(kcal|cal|kj)?\b", re.I),
+        ],
+        "kcal",
+    ),
+    "fat_g_per_100g": ([re.compile(rf"\bfats?\b\D{{0,15}}?{NUMBER}\s*(mg|g)?\b", re.I)], "g"),
+    "sodium_g_per_100g": ([re.compile(rf"\bsodium\b\D{{0,15}}?{NUMBER}\s*(mg|g)?\b", re.I)], "mg"),
+    "sugar_g_per_100g": ([re.compile(rf"\bsugars?\b\D{{0,15}}?{NUMBER}\s*(mg|g)?\b", re.I)], "g"),
+}
+# Factor to the metadata unit (kcal or g)
+UNIT_FACTORS = {"kcal": 1.0, "cal": 1.0, "kj": 1 / 4.184, "g": 1.0, "mg": 0.001}
+BASIS = re.compile(rf"per\s+{NUMBER}\s*(?:g|ml)\b", re.I)
+
+
+def parse_per_100g(document: str) -> Optional[Dict[str, float]]:
+    """Per-100g nutrient values stated in a food_facts document, or None if any
+    is missing or ambiguous (see nutrition.parse_number)."""
+    basis = BASIS.search(document)
+    scale = 1.0
+    if basis:
+        amount = parse_number(basis.group(1))
+        if amount is None:
+            return None
+        scale = 100.0 / amount if amount else 1.0
+
+    values = {}
+    for key, (patterns, default_unit) in PATTERNS.items():
+        match = next(filter(None, (pattern.search(document) for pattern in patterns)), None)
+        if match is None:
+            return None
+        value = parse_number(match.group(1))
+        if value is None:
+            return None
+        value *= UNIT_FACTORS[(match.group(2) or default_unit).lower()]
+        values[key] = round(value * scale, 4)
+    return values
+
+
+def open_collection():
+    client = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
+    return client.get_collection(COLLECTION)
+
+
+def bump_version(collection):
+    # hnsw:* settings are fixed at creation and may not be passed to modify()
+    metadata = {k: v for k, v in (collection.metadata or {}).items() if not k.startswith("hnsw:")}
+    metadata["nutrients_version"] = int(time.time())
+    collection.modify(metadata=metadata)
+
+
+def backfill(dry_run: bool = False):
+    collection = open_collection()
+    total = collection.count()
+    parsed = 0
+    for offset in range(0, total, PAGE_SIZE):
+        page = collection.get(include=["documents", "metadatas"], limit=PAGE_SIZE, offset=offset)
+        ids, metadatas = [], []
+        for doc_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+            values = parse_per_100g(document or "")
+            if values is None:
+                continue
+            ids.append(doc_id)
+            metadatas.append({**(metadata or {}), **values})
+        parsed += len(ids)
+        if ids and not dry_run:
+            collection.update(ids=ids, metadatas=metadatas)
+    print(f"{parsed}/{total} documents have per-100g nutrient values")
+    if not dry_run:
+        bump_version(collection)
+
+
+def import_csv(path: str):
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    if not rows:
+        print("No rows to import")
+        return
+
+    ids, documents, metadatas = [], [], []
+    for row in rows:
+        name = row["name"].strip()
+        values = {
+            "kcal_per_100g": float(row["kcal"]),
+            "fat_g_per_100g": float(row["fat_g"]),
+            "sodium_g_per_100g": float(row["sodium_mg"]) / 1000.0,
+            "sugar_g_per_100g": float(row["sugar_g"]),
+        }
+        ids.append("csv-" + re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-"))
+        documents.append(
+            f"{name}: per 100g, calories {values['kcal_per_100g']} kcal, "
+            f"fat {values['fat_g_per_100g']} g, sodium {row['sodium_mg']} mg, "
+            f"sugar {values['sugar_g_per_100g']} g"
+        )
+        metadatas.append({"name": name, **values})
+
+    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL).embed_documents(documents)
+    collection = open_collection()
+    collection.upsert(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+    bump_version(collection)
+    print(f"Imported {len(ids)} foods into {COLLECTION}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the nutrient metadata on food_facts")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = commands.add_parser("backfill", help="parse nutrient metadata from document text")
+    backfill_parser.add_argument("--dry-run", action="store_true")
+    import_parser = commands.add_parser("import-csv", help="add foods with per-100g values from a CSV")
+    import_parser.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.command == "backfill":
+        backfill(args.dry_run)
+    else:
+        import_csv(args.path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+# Cache of ingredient -> closest food_facts match.
+#
+# Most meals are made of the same few hundred ingredients, so the vector store
+# lookup for "rice 150g" is the same as for "Rice (200 g)". Entries are keyed on
+# the ingredient name with quantities and units stripped, hold the matched
+# document, its distance and its metadata, and are evicted least recently used
+# first.
+#
+# With a path, the cache is loaded from and saved to a JSON file so it survives
+# restarts. The file records a signature of the collection it was built from
+# (name, size, nutrient metadata version, embedding model); a file with a
+# different signature is ignored, so re-indexing food_facts starts a fresh cache.
+
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+UNITS = (
+    r"kg|g|gr|gram|grams|mg|ml|l|litre|liter|oz|lb|lbs|cups?|tbsp|tsp|"
+    r"tablespoons?|teaspoons?|pieces?|pcs|slices?|servings?|bowls?|pinch"
+)
+QUANTITY = re.compile(rf"\(?\b\d+(?:[.,/]\d+)?\s*(?:{UNITS})?\b\.?\)?", re.IGNORECASE)
+
+
+def normalize_ingredient(ingredient: str) -> str:
+    """'Chicken breast 80g' -> 'chicken breast', '2 cups Rice' -> 'rice'."""
+    name = QUANTITY.sub(" ", ingredient.lower())
+    name = re.sub(r"[^\w\s'-]", " ", name)
+    return " ".join(name.split())
+
+
+# (document, distance, metadata)
+Match = Tuple[str, Optional[float], Dict[str, Any]]
+
+
+class IngredientCache:
+    def __init__(self, max_entries: int = 2000, path: Optional[str] = None,
+                 signature: str = "", flush_every: int = 20):
+        self.max_entries = max_entries
+        self.path = path
+        self.signature = signature
+        self.flush_every = flush_every
+        self._entries: "OrderedDict[str, Match]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = 0
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self._load()
+
+    def get(self, name: str) -> Optional[Match]:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return entry
+
+    def put_many(self, matches: Dict[str, Match]):
+        with self._lock:
+            for name, entry in matches.items():
+                self._entries[name] = entry
+                self._entries.move_to_end(name)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty += len(matches)
+            flush = self.path and self._dirty >= self.flush_every
+        if flush:
+            self.save()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Ingredient cache: ignoring unreadable {self.path}: {e}")
+            return
+        if saved.get("signature") != self.signature:
+            print("Ingredient cache: food_facts changed since the cache was saved, starting empty")
+            return
+        for name, document, distance, metadata in saved.get("entries", [])[-self.max_entries:]:
+            self._entries[name] = (document, distance, metadata or {})
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            entries: List[list] = [[name, *match] for name, match in self._entries.items()]
+            self._dirty = 0
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with self._save_lock:
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"signature": self.signature, "entries": entries}, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Ingredient cache: could not save {self.path}: {e}")
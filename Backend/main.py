@@ -1,13 +1,20 @@
 
 # standard library
 import ast
+import asyncio
 import base64
-import io
+import copy
+import functools
+import hashlib
 import json
 import os
 import random
 import re
-from datetime import date, datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional
 import PIL.Image 
 
@@ -17,28 +24,30 @@ import firebase_admin
 from firebase_admin import credentials, db
 from fastapi import FastAPI, File, Form, HTTPException, Query, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-import numpy as np
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
 import pandas as pd
-from PIL import Image
-import requests
-import openai
-import chromadb
-from chromadb.config import Settings
-import google.generativeai as genai
-from google.genai.types import GenerateContentConfig, HttpOptions
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 
-# project-specific / LangChain
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
+# project-specific
+# (google.generativeai, openai, chromadb and the embedding model are imported
+# lazily by the subsystems in section 0d)
+from chat_sessions import ChatSessionManager
+from code_runner import CodeRunner, requested_tables
+from conversation_memory import conversation_memory_from_env
+from embeddings import embedding_backend_from_env
+from image_cache import ImageAnalysisCache
+from image_host import ImageHostError, LocalImageHost, image_host_from_env
+from image_prep import ImageTooLargeError, prepare_image, read_upload
+from ingredient_cache import IngredientCache, normalize_ingredient
+from nutrition import calculate_totals
+from vector_store import ensure_extracted
+from memory_db import InMemoryDatabase
 
 
 
 app = FastAPI()
 
-with open("AI_memory.txt", "w") as file:
-        file.write(f" ")
-
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # or specify your frontend URL like ["http://localhost:3000"]
@@ -47,11 +56,911 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ——— 0) Thread pools for the blocking clients ———
+# firebase_admin.db, google.generativeai and openai are all
+# synchronous. Calling them straight from an async handler stalls the event loop
+# (and every other in-flight request) for the length of the call, so they run
+# in a bounded thread pool per backend instead. The pool size is the backend's
+# concurrency limit; extra calls queue for a free worker.
+BACKEND_WORKERS = {
+    "firebase": int(os.getenv("FIREBASE_MAX_WORKERS", "16")),
+    "gemini": int(os.getenv("GEMINI_MAX_WORKERS", "8")),
+    "openai": int(os.getenv("OPENAI_MAX_WORKERS", "4")),
+    "chroma": int(os.getenv("CHROMA_MAX_WORKERS", "4")),
+    "analytics": int(os.getenv("ANALYTICS_MAX_WORKERS", "2")),
+    "image": int(os.getenv("IMAGE_MAX_WORKERS", "4")),
+}
+
+backend_executors = {
+    name: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-worker")
+    for name, workers in BACKEND_WORKERS.items()
+}
+
+
+async def run_blocking(backend: str, fn, *args, **kwargs):
+    """Run a blocking call in `backend`'s thread pool and await the result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        backend_executors[backend], functools.partial(fn, *args, **kwargs)
+    )
+
+
+async def iterate_blocking(backend: str, fn, *args, **kwargs):
+    """Call `fn` on `backend`'s pool and yield the items of the blocking iterator
+    it returns (a streaming LLM response), fetching each one on the pool too."""
+    iterator = await run_blocking(backend, lambda: iter(fn(*args, **kwargs)))
+    done = object()
+    try:
+        while True:
+            item = await run_blocking(backend, next, iterator, done)
+            if item is done:
+                return
+            yield item
+    finally:
+        # Lets a generator release what it holds if the client went away
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            try:
+                close()
+            except ValueError:  # still running on the pool; closed when collected
+                pass
+
+
+def runs_on(backend: str):
+    """Turn a blocking handler into an async one that runs on `backend`'s pool.
+    The wrapped signature is kept, so FastAPI still sees the same parameters."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await run_blocking(backend, fn, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ——— 0b) Image host ———
+# Meal photos and chatbot graphs go through one shared async HTTP client
+# (image_host.py) with keep-alive, timeouts and bounded retries.
+load_dotenv(dotenv_path="api_keys.env")
+image_host = image_host_from_env()
+
+if isinstance(image_host, LocalImageHost):
+    app.mount("/images", StaticFiles(directory=image_host.directory), name="images")
+
+
+@app.on_event("shutdown")
+async def close_image_host():
+    await image_host.aclose()
+
+
+async def upload_image_or_none(contents: bytes, filename: Optional[str] = None) -> Optional[str]:
+    """Upload a meal photo, returning None instead of raising if the host fails,
+    so a failed upload never throws away the food analysis."""
+    try:
+        return await image_host.upload(contents, filename)
+    except ImageHostError as e:
+        print(f"Image upload failed: {e}")
+        return None
+
+
+def start_image_upload(contents: bytes, filename: Optional[str] = None) -> asyncio.Task:
+    """Start the upload in the background. The upload does not depend on the
+    Gemini analysis, so the two overlap; await the task once the analysis is
+    done, and cancel it if the request fails first."""
+    return asyncio.create_task(upload_image_or_none(contents, filename))
+
+
+# ——— 0c) Cache of analysed food photos ———
+# Repeat photos of the same meal (exact or near-duplicate, see image_cache.py)
+# reuse the earlier nutrition JSON and skip Gemini and Chroma entirely.
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "1") == "1"
+
+image_cache = ImageAnalysisCache(
+    max_distance=int(os.getenv("IMAGE_CACHE_MAX_DISTANCE", "6")),
+    ttl=float(os.getenv("IMAGE_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    max_entries=int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "5000")),
+    hash_name=os.getenv("IMAGE_CACHE_HASH", "phash"),
+) if IMAGE_CACHE_ENABLED else None
+
+
+async def lookup_analysis(namespace: str, image):
+    """Returns (fingerprint, cached answer or None) for a prepared image."""
+    if image_cache is None:
+        return None, None
+    return await run_blocking("image", image_cache.lookup, namespace, image.data)
+
+
+def remember_analysis(namespace: str, fingerprint, answer_json: Dict[str, Any]):
+    if image_cache is not None and fingerprint is not None:
+        image_cache.put(namespace, fingerprint, answer_json)
+
+
+# ——— 0d) Lazily initialized subsystems ———
+# The AI clients, the Chroma store and the embedding model take tens of seconds
+# to import and load. Each is a Subsystem built on first use, so the dashboard
+# endpoints (which only need Firebase) serve as soon as the process is up. At
+# startup they are warmed up in a background thread, and /ready reports where
+# each one is.
+class Subsystem:
+    def __init__(self, name: str, factory):
+        self.name = name
+        self.factory = factory
+        self.state = "idle"  # idle -> loading -> ready | failed
+        self.error: Optional[str] = None
+        self.seconds: Optional[float] = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.state == "ready"
+
+    def get(self):
+        if self.state == "ready":
+            return self._value
+        with self._lock:
+            if self.state != "ready":
+                self.state = "loading"
+                started = time.time()
+                try:
+                    self._value = self.factory()
+                except Exception as e:
+                    self.state = "failed"
+                    self.error = repr(e)
+                    raise
+                self.seconds = round(time.time() - started, 2)
+                self.error = None
+                self.state = "ready"
+        return self._value
+
+    def status(self) -> Dict[str, Any]:
+        return {"state": self.state, "seconds": self.seconds, "error": self.error}
+
+
+subsystems: Dict[str, Subsystem] = {}
+
+
+def register_subsystem(name: str, factory) -> Subsystem:
+    subsystems[name] = Subsystem(name, factory)
+    return subsystems[name]
+
+
+WARMUP_SUBSYSTEMS = [
+    name.strip()
+    for name in os.getenv("WARMUP_SUBSYSTEMS", "gemini,openai,chroma,embeddings,ingredient_cache,code_runner").split(",")
+    if name.strip()
+]
+
+
+def warm_up(names: List[str]):
+    for name in names:
+        try:
+            subsystems[name].get()
+            print(f"Warm-up: {name} ready in {subsystems[name].seconds}s")
+        except Exception as e:
+            print(f"Warm-up: {name} failed: {e}")
+
+
+@app.on_event("startup")
+async def start_warm_up():
+    threading.Thread(target=warm_up, args=(WARMUP_SUBSYSTEMS,), name="warm-up", daemon=True).start()
+
+
+@app.get("/ready")
+def ready():
+    """Per-subsystem warm-up state. Ready (200) once Firebase is up, which is all
+    the dashboard endpoints need; the AI endpoints load what they use on demand."""
+    status = {name: subsystem.status() for name, subsystem in subsystems.items()}
+    is_ready = subsystems["firebase"].loaded
+    return JSONResponse(
+        status_code=200 if is_ready else 503,
+        content={"ready": is_ready, "subsystems": status},
+    )
+
+
+# ——— 0e) Server-Sent Events ———
+# The streaming endpoints produce (event, data) pairs; these turn them into a
+# text/event-stream response. Once streaming has started the status code is
+# already sent, so a failure is reported as an "error" event instead.
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def sse_stream(events):
+    try:
+        async for event, data in events:
+            yield sse_event(event, data)
+    except HTTPException as e:
+        yield sse_event("error", {"detail": e.detail})
+    except Exception as e:
+        print(f"Error while streaming: {e}")
+        yield sse_event("error", {"detail": str(e)})
+
+
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        sse_stream(events),
+        media_type="text/event-stream",
+        # No caching, and no buffering in front of the app (nginx)
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ——— 1) Initialize Firebase Admin (do this once) ———
-cred = credentials.Certificate('credentials.json')
-firebase_admin.initialize_app(cred, {
-    'databaseURL': 'https://ellm-hackathon-default-rtdb.asia-southeast1.firebasedatabase.app/'
-})
+# FIREBASE_BACKEND=memory swaps the realtime database for the in-memory stand-in
+# in memory_db.py (same query semantics), so the API can run offline.
+FIREBASE_BACKEND = os.getenv("FIREBASE_BACKEND", "firebase")
+
+
+def init_firebase():
+    if FIREBASE_BACKEND == "memory":
+        return InMemoryDatabase.from_files(
+            os.getenv("FIREBASE_MEMORY_SEED"),
+            os.getenv("FIREBASE_RULES", "database.rules.json"),
+        )
+    cred = credentials.Certificate('credentials.json')
+    firebase_admin.initialize_app(cred, {
+        'databaseURL': 'https://ellm-hackathon-default-rtdb.asia-southeast1.firebasedatabase.app/'
+    })
+    return None
+
+
+# Cheap, and everything but the AI endpoints needs it, so it is not deferred
+memory_database = register_subsystem("firebase", init_firebase).get()
+
+
+def get_reference(path: str):
+    if FIREBASE_BACKEND == "memory":
+        return memory_database.reference(path)
+    return db.reference(path)
+
+# ——— 1b) Shared in-process table cache ———
+# Most endpoints need a whole table (or a slice of it), so instead of downloading
+# it on every request we keep the hot tables in memory. Each cached table is kept
+# fresh either by a Firebase streaming listener ("listen" mode) or by a cheap
+# ETag revalidation on access ("etag" mode). Tables are evicted least recently
+# used first once the cache goes over its memory budget.
+CACHED_TABLES = (
+    "diet_logs",
+    "steps_table",
+    "exercise",
+    "patient_table",
+    "dr_table",
+    "diet_plan_settings",
+    "daily_nutrient_rollup",
+)
+
+# Log tables that also get a PatientID -> rows secondary index, so per-patient
+# reads cost O(that patient's rows) instead of a scan over every patient's logs
+INDEXED_TABLES = ("diet_logs", "steps_table", "exercise")
+
+
+# Known columns, used to shape empty results when a table isn't cached
+TABLE_COLUMNS = {
+    "diet_logs": ("PatientID", "calorie_intake", "datetime", "fat_intake",
+                  "imagelink", "notes", "sodium_intake", "sugar_intake"),
+    "steps_table": ("Date", "NumberOfSteps", "PatientID"),
+    "exercise": ("Datetime", "PatientID"),
+    "diet_plan_settings": ("Max_Fat", "Max_Sodium", "Max_Sugar", "Notes",
+                           "PatientID", "Target_Daily_Calories"),
+    "patient_table": ("Age", "DateOfBirth", "Email", "HealthCondition",
+                      "PatientID", "PatientName", "patient_status"),
+}
+
+# Date field of each log table. Values are "YYYY-MM-DD[ HH:MM:SS]" strings, so
+# string order is date order.
+DATE_FIELDS = {
+    "diet_logs": "datetime",
+    "steps_table": "Date",
+    "exercise": "Datetime",
+}
+
+
+def patient_key(value):
+    """PatientIDs are ints, but older rows may hold them as strings."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def latest_by_patient(records, field: str) -> Dict[Any, pd.Timestamp]:
+    """PatientID -> latest `field` timestamp over `records`, in one vectorized pass."""
+    df = pd.DataFrame(list(records), columns=["PatientID", field])
+    if df.empty:
+        return {}
+    df["PatientID"] = df["PatientID"].map(patient_key)
+    df[field] = pd.to_datetime(df[field], errors="coerce")
+    return df.dropna(subset=[field]).groupby("PatientID")[field].max().to_dict()
+
+
+def normalize_table(raw) -> Dict[str, Any]:
+    """Turn a raw Firebase snapshot (dict, list or None) into a {key: record} dict."""
+    if isinstance(raw, dict):
+        return {str(k): v for k, v in raw.items() if v is not None}
+    if isinstance(raw, list):
+        return {str(i): v for i, v in enumerate(raw) if v is not None}
+    return {}
+
+
+def estimate_size(value) -> int:
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+class CachedTable:
+    def __init__(self, name: str):
+        self.name = name
+        self.rows: Dict[str, Any] = {}
+        self.size = 0
+        self.etag = None
+        self.listener = None
+        self.loaded = threading.Event()
+        self.last_checked = 0.0
+        self.columns: Dict[str, None] = {}  # ordered set of every field seen
+        self.index: Optional[Dict[Any, Dict[str, Any]]] = (
+            {} if name in INDEXED_TABLES else None
+        )
+        # PatientID -> latest log time, maintained alongside the index
+        self.latest: Dict[Any, pd.Timestamp] = {}
+
+
+class TableCache:
+    def __init__(self, tables, max_bytes: int, mode: str = "listen",
+                 load_timeout: float = 10.0, revalidate_seconds: float = 5.0):
+        self.tables = set(tables)
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.load_timeout = load_timeout
+        self.revalidate_seconds = revalidate_seconds
+        self._entries: "OrderedDict[str, CachedTable]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    # ---- reads ----
+    def get_table(self, name: str) -> Dict[str, Any]:
+        """Return a {key: record} snapshot of the table, loading it if needed."""
+        entry = self._entry(name) if name in self.tables else None
+        if entry is None:
+            # Not cached, too big for the budget or the listener never delivered
+            return normalize_table(get_reference(name).get())
+        with self._lock:
+            return dict(entry.rows)
+
+    def get_records(self, name: str) -> List[Dict[str, Any]]:
+        return list(self.get_table(name).values())
+
+    def get_patient_records(self, name: str, patient_ids) -> List[Dict[str, Any]]:
+        """Rows of `name` belonging to any of `patient_ids`, grouped by patient."""
+        ids = [patient_key(p) for p in patient_ids]
+        entry = self._entry(name) if name in self.tables else None
+        if entry is None:
+            # Not cached: let the database do the filtering
+            return query_patient_rows(name, ids)
+        if entry.index is None:
+            wanted = set(ids)
+            with self._lock:
+                rows = list(entry.rows.values())
+            return [r for r in rows if patient_key(r.get("PatientID")) in wanted]
+
+        with self._lock:
+            records = []
+            for pid in dict.fromkeys(ids):
+                records.extend(entry.index.get(pid, {}).values())
+            return records
+
+    def get_row(self, name: str, key) -> Any:
+        """A single top-level child of the table, without copying the table."""
+        entry = self._entry(name) if name in self.tables else None
+        if entry is None:
+            return get_reference(f"{name}/{key}").get()
+        with self._lock:
+            return entry.rows.get(str(key))
+
+    def get_columns(self, name: str) -> List[str]:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry.columns:
+                return list(entry.columns)
+        return list(TABLE_COLUMNS.get(name, ()))
+
+    def _entry(self, name: str) -> Optional[CachedTable]:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+
+        if entry is None:
+            entry = self._load(name)
+        elif self.mode == "etag":
+            self._revalidate(entry)
+        return entry
+
+    def _load(self, name: str) -> Optional[CachedTable]:
+        entry = CachedTable(name)
+        ref = get_reference(name)
+
+        if self.mode == "listen":
+            entry.listener = ref.listen(lambda event: self._on_event(entry, event))
+            if not entry.loaded.wait(self.load_timeout):
+                print(f"Table cache: listener for '{name}' did not deliver a snapshot in time")
+                entry.listener.close()
+                return None
+        else:
+            raw, entry.etag = ref.get(etag=True)
+            self._replace_rows(entry, normalize_table(raw))
+            entry.last_checked = time.monotonic()
+            entry.loaded.set()
+
+        result, to_close = entry, []
+        with self._lock:
+            existing = self._entries.get(name)
+            if entry.size > self.max_bytes:
+                print(f"Table cache: '{name}' ({entry.size} bytes) exceeds the budget, not caching")
+                result, to_close = None, [entry]
+            elif existing is not None:
+                # another request loaded the same table in the meantime
+                result, to_close = existing, [entry]
+            else:
+                self._entries[name] = entry
+                to_close = self._evict()
+        self._close_listeners(to_close)
+        return result
+
+    def _revalidate(self, entry: CachedTable):
+        now = time.monotonic()
+        if now - entry.last_checked < self.revalidate_seconds:
+            return
+        changed, raw, etag = get_reference(entry.name).get_if_changed(entry.etag)
+        to_close = []
+        with self._lock:
+            entry.last_checked = now
+            if changed:
+                self._replace_rows(entry, normalize_table(raw))
+                entry.etag = etag
+                to_close = self._evict()
+        self._close_listeners(to_close)
+
+    # ---- writes ----
+    def _on_event(self, entry: CachedTable, event):
+        to_close = []
+        with self._lock:
+            self._apply(entry, event.event_type, event.path, event.data)
+            if entry.loaded.is_set():
+                to_close = self._evict()
+        entry.loaded.set()
+        if to_close:
+            # This is a listener thread, and closing a listener joins its
+            # thread, possibly this one, so hand the closing off
+            threading.Thread(
+                target=self._close_listeners, args=(to_close,),
+                name="table-cache-close", daemon=True,
+            ).start()
+
+    def apply_write(self, name: str, key: str, record):
+        """Write-through after a push/set so this worker reads its own writes
+        without waiting for the listener round trip."""
+        self._apply_if_cached(name, "put", f"/{key}", record)
+
+    def apply_update(self, name: str, key: str, fields: Dict[str, Any]):
+        self._apply_if_cached(name, "patch", f"/{key}", fields)
+
+    def _apply_if_cached(self, name, event_type, path, data):
+        to_close = []
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._apply(entry, event_type, path, data)
+                to_close = self._evict()
+        self._close_listeners(to_close)
+
+    def _apply(self, entry: CachedTable, event_type: str, path: str, data):
+        parts = [p for p in (path or "/").split("/") if p]
+
+        if not parts:
+            if event_type == "put":
+                self._replace_rows(entry, normalize_table(data))
+            else:
+                for key, value in (data or {}).items():
+                    self._set_row(entry, str(key), value)
+            return
+
+        key, sub = parts[0], parts[1:]
+        if not sub and event_type == "put":
+            self._set_row(entry, key, data)
+            return
+
+        # Partial change: apply it to a copy of the row, so snapshots already
+        # handed out to readers are never mutated
+        row = copy.deepcopy(entry.rows.get(key) or {})
+        target = row
+        for part in sub[:-1]:
+            target = target.setdefault(part, {})
+
+        if sub and event_type == "put":
+            if data is None:
+                target.pop(sub[-1], None)
+            else:
+                target[sub[-1]] = data
+        else:
+            if sub:
+                target = target.setdefault(sub[-1], {})
+            for field, value in (data or {}).items():
+                if value is None:
+                    target.pop(field, None)
+                else:
+                    target[field] = value
+
+        self._set_row(entry, key, row or None)
+
+    def _replace_rows(self, entry: CachedTable, rows: Dict[str, Any]):
+        entry.rows = rows
+        entry.size = estimate_size(rows)
+        entry.columns = {}
+        for row in rows.values():
+            if isinstance(row, dict):
+                entry.columns.update(dict.fromkeys(row))
+        if entry.index is not None:
+            entry.index = {}
+            for key, row in rows.items():
+                self._index_add(entry, key, row, track_latest=False)
+            entry.latest = latest_by_patient(rows.values(), DATE_FIELDS[entry.name])
+
+    def _set_row(self, entry: CachedTable, key: str, value):
+        old = entry.rows.get(key)
+        if old is not None:
+            entry.size -= estimate_size(old)
+            self._index_remove(entry, key, old)
+        if value is None:
+            entry.rows.pop(key, None)
+        else:
+            entry.rows[key] = value
+            entry.size += estimate_size(value)
+            if isinstance(value, dict):
+                entry.columns.update(dict.fromkeys(value))
+            self._index_add(entry, key, value)
+
+    def _index_add(self, entry: CachedTable, key: str, row, track_latest: bool = True):
+        if entry.index is None or not isinstance(row, dict):
+            return
+        pid = patient_key(row.get("PatientID"))
+        entry.index.setdefault(pid, {})[key] = row
+
+        if track_latest:
+            ts = pd.to_datetime(row.get(DATE_FIELDS[entry.name]), errors="coerce")
+            if not pd.isna(ts) and (pid not in entry.latest or ts > entry.latest[pid]):
+                entry.latest[pid] = ts
+
+    def _index_remove(self, entry: CachedTable, key: str, row):
+        if entry.index is None or not isinstance(row, dict):
+            return
+        pid = patient_key(row.get("PatientID"))
+        slot = entry.index.get(pid)
+        if slot is not None:
+            slot.pop(key, None)
+            if not slot:
+                del entry.index[pid]
+
+        # Only a removed row holding the patient's latest time needs a recompute
+        field = DATE_FIELDS[entry.name]
+        ts = pd.to_datetime(row.get(field), errors="coerce")
+        if not pd.isna(ts) and entry.latest.get(pid) == ts:
+            remaining = latest_by_patient((slot or {}).values(), field)
+            if pid in remaining:
+                entry.latest[pid] = remaining[pid]
+            else:
+                entry.latest.pop(pid, None)
+
+    def get_latest(self, name: str, patient_ids) -> Optional[Dict[Any, pd.Timestamp]]:
+        """PatientID -> latest log time for `patient_ids`, or None when the
+        table isn't cached (callers then compute it from a query)."""
+        entry = self._entry(name) if name in self.tables else None
+        if entry is None or entry.index is None:
+            return None
+        with self._lock:
+            return {
+                patient_key(p): entry.latest[patient_key(p)]
+                for p in patient_ids
+                if patient_key(p) in entry.latest
+            }
+
+    # ---- housekeeping ----
+    def total_size(self) -> int:
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    def _evict(self) -> List[CachedTable]:
+        """Drop least recently used tables until the cache fits its budget.
+        Call with the lock held; returns the dropped entries, whose listeners
+        the caller closes once it has released the lock."""
+        evicted = []
+        while len(self._entries) > 1 and self.total_size() > self.max_bytes:
+            name, entry = self._entries.popitem(last=False)
+            print(f"Table cache: evicting '{name}' ({entry.size} bytes)")
+            evicted.append(entry)
+        return evicted
+
+    def _close_listeners(self, entries: List[CachedTable]):
+        # Never with self._lock held: close() joins the listener thread, which
+        # may be waiting for that lock in _on_event (and the in-memory backend
+        # takes its own lock, which it holds while calling _on_event)
+        for entry in entries:
+            if entry.listener is not None:
+                try:
+                    entry.listener.close()
+                except Exception as e:
+                    print(f"Table cache: error closing listener for '{entry.name}': {e}")
+                entry.listener = None
+
+    def invalidate(self, name: Optional[str] = None):
+        with self._lock:
+            names = [name] if name else list(self._entries)
+            removed = [self._entries.pop(n) for n in names if n in self._entries]
+        self._close_listeners(removed)
+
+
+table_cache = TableCache(
+    CACHED_TABLES if os.getenv("TABLE_CACHE_ENABLED", "1") == "1" else (),
+    max_bytes=int(float(os.getenv("TABLE_CACHE_MAX_MB", "256")) * 1024 * 1024),
+    mode=os.getenv("TABLE_CACHE_MODE", "listen"),
+    load_timeout=float(os.getenv("TABLE_CACHE_LOAD_TIMEOUT", "10")),
+    revalidate_seconds=float(os.getenv("TABLE_CACHE_REVALIDATE_SECONDS", "5")),
+)
+
+
+def load_table(table_name: str) -> Dict[str, Any]:
+    return table_cache.get_table(table_name)
+
+
+def load_records(table_name: str) -> List[Dict[str, Any]]:
+    return table_cache.get_records(table_name)
+
+
+# ——— 1c) Filtered queries ———
+# Used whenever a table isn't served from the cache, so that the download is
+# the size of the answer rather than the size of the table.
+def query_patient_rows(table_name: str, patient_ids) -> List[Dict[str, Any]]:
+    records = []
+    for pid in dict.fromkeys(patient_ids):
+        if pid is None:
+            # equal_to(None) raises; a null PatientID has no rows
+            continue
+        raw = get_reference(table_name).order_by_child("PatientID").equal_to(pid).get()
+        records.extend(normalize_table(raw).values())
+    return records
+
+
+def load_patient_frame(table_name: str, patient_ids) -> pd.DataFrame:
+    """DataFrame of the rows in `table_name` for one PatientID or a list of them.
+
+    Served from the per-patient index when the table is cached, otherwise by a
+    PatientID query. It always carries the table's columns so an empty result
+    still behaves like a filtered full-table DataFrame.
+    """
+    if not isinstance(patient_ids, (list, tuple, set)):
+        patient_ids = [patient_ids]
+    records = table_cache.get_patient_records(table_name, patient_ids)
+    columns = table_cache.get_columns(table_name)
+    if not columns:
+        return pd.DataFrame(records)
+    return pd.DataFrame(records, columns=columns)
+
+
+def push_record(table_name: str, record: Dict[str, Any]):
+    new_ref = get_reference(table_name).push(record)
+    table_cache.apply_write(table_name, new_ref.key, record)
+    return new_ref
+
+
+def update_record(table_name: str, key: str, fields: Dict[str, Any]):
+    get_reference(table_name).child(key).update(fields)
+    table_cache.apply_update(table_name, key, fields)
+
+# ——— 1d) Daily nutrient rollup ———
+# daily_nutrient_rollup/{PatientID} = {"backfilled": true, "days": {"YYYY-MM-DD":
+# {calorie_intake, fat_intake, sodium_intake, sugar_intake, count}}}
+# It is incremented on every diet log written through the API, and a patient's
+# node is backfilled from diet_logs the first time it is needed, so the nutrient
+# endpoints never have to re-parse and group a patient's whole log history.
+ROLLUP_TABLE = "daily_nutrient_rollup"
+NUTRIENT_FIELDS = ["calorie_intake", "fat_intake", "sodium_intake", "sugar_intake"]
+
+
+def log_date(value) -> Optional[str]:
+    ts = pd.to_datetime(value, errors="coerce")
+    return None if pd.isna(ts) else ts.strftime("%Y-%m-%d")
+
+
+def summarize_daily(records) -> Dict[Any, Dict[str, Dict[str, float]]]:
+    """PatientID -> {date: totals} over diet log records, in one groupby."""
+    df = pd.DataFrame(list(records), columns=["PatientID", "datetime"] + NUTRIENT_FIELDS)
+    if df.empty:
+        return {}
+    df["PatientID"] = df["PatientID"].map(patient_key)
+    df["date"] = pd.to_datetime(df["datetime"], errors="coerce").dt.strftime("%Y-%m-%d")
+    df[NUTRIENT_FIELDS] = df[NUTRIENT_FIELDS].apply(pd.to_numeric, errors="coerce").fillna(0)
+    df = df.dropna(subset=["date"])
+
+    grouped = df.groupby(["PatientID", "date"])
+    totals = grouped[NUTRIENT_FIELDS].sum()
+    totals["count"] = grouped.size()
+
+    summary: Dict[Any, Dict[str, Dict[str, float]]] = {}
+    for (pid, day), row in totals.iterrows():
+        summary.setdefault(pid, {})[day] = {
+            **{field: round(float(row[field]), 4) for field in NUTRIENT_FIELDS},
+            "count": int(row["count"]),
+        }
+    return summary
+
+
+def backfill_node(pid) -> Dict[str, Any]:
+    logs = load_patient_frame("diet_logs", pid).to_dict(orient="records")
+    return {"backfilled": True, "days": summarize_daily(logs).get(pid, {})}
+
+
+def rebuild_patient_rollup(patientid, force: bool = False) -> Dict[str, Any]:
+    """Backfill a patient's node from diet_logs and return the node as stored.
+
+    Written in a transaction that keeps a node another worker has already
+    backfilled (it may hold increments from add_to_rollup since). force=True
+    recomputes even a backfilled node; that repair must run while no diet logs
+    are being written for the patient, or increments landing during it are
+    lost."""
+    pid = patient_key(patientid)
+    rebuilt = backfill_node(pid)
+
+    def backfill(current):
+        if not force and current and current.get("backfilled"):
+            return current
+        return rebuilt
+
+    node = get_reference(f"{ROLLUP_TABLE}/{pid}").transaction(backfill)
+    table_cache.apply_write(ROLLUP_TABLE, str(pid), node)
+    return node
+
+
+def rebuild_nutrient_rollup() -> int:
+    """Recompute the whole rollup table from diet_logs. Returns the patient count.
+    This overwrites the table, so run it while no diet logs are being written
+    (increments landing during the rebuild are lost)."""
+    summary = summarize_daily(load_records("diet_logs"))
+    table = {str(pid): {"backfilled": True, "days": days} for pid, days in summary.items()}
+    get_reference(ROLLUP_TABLE).set(table)
+    table_cache.invalidate(ROLLUP_TABLE)
+    return len(table)
+
+
+class BackfillNeeded(Exception):
+    pass
+
+
+def add_log_totals(totals: Optional[Dict[str, Any]], log: Dict[str, Any]) -> Dict[str, Any]:
+    totals = totals or {"count": 0, **{field: 0 for field in NUTRIENT_FIELDS}}
+    for field in NUTRIENT_FIELDS:
+        try:
+            totals[field] = round(float(totals.get(field) or 0) + float(log.get(field) or 0), 4)
+        except (TypeError, ValueError):
+            pass
+    totals["count"] = int(totals.get("count") or 0) + 1
+    return totals
+
+
+def add_to_rollup(log: Dict[str, Any]):
+    """Count a diet log that was just written in its patient's rollup.
+
+    Whether the node still needs its backfill is decided inside the
+    transaction, from the stored node: a backfilled node gets this log's
+    increment, otherwise it is replaced by a backfill read after the log was
+    written (so it includes it). The cached node is only a hint for whether to
+    read diet_logs up front."""
+    pid = patient_key(log.get("PatientID"))
+    day = log_date(log.get("datetime"))
+    if day is None:
+        return
+
+    node = table_cache.get_row(ROLLUP_TABLE, pid)
+    rebuilt = None if node and node.get("backfilled") else backfill_node(pid)
+
+    def increment(current):
+        if current and current.get("backfilled"):
+            days = current.get("days") or {}
+            days[day] = add_log_totals(days.get(day), log)
+            current["days"] = days
+            return current
+        if rebuilt is None:
+            # The cached node was stale; read diet_logs outside the transaction
+            raise BackfillNeeded
+        return rebuilt
+
+    ref = get_reference(f"{ROLLUP_TABLE}/{pid}")
+    try:
+        node = ref.transaction(increment)
+    except BackfillNeeded:
+        rebuilt = backfill_node(pid)
+        node = ref.transaction(increment)
+    table_cache.apply_write(ROLLUP_TABLE, str(pid), node)
+
+
+def record_diet_log(new_diet_log: Dict[str, Any]):
+    """Write a diet log and fold it into the daily rollup."""
+    new_ref = push_record("diet_logs", new_diet_log)
+    try:
+        add_to_rollup(new_diet_log)
+    except Exception as e:
+        # The log itself is saved; /rebuild_nutrient_rollup repairs the rollup
+        print(f"Error updating nutrient rollup: {e}")
+    return new_ref
+
+
+def load_daily_rollup(patientid) -> pd.DataFrame:
+    """One row per logged day: date, nutrient totals and count of entries."""
+    node = table_cache.get_row(ROLLUP_TABLE, patient_key(patientid))
+    if not node or not node.get("backfilled"):
+        node = rebuild_patient_rollup(patientid)
+
+    days = node.get("days") or {}
+    df = pd.DataFrame.from_dict(days, orient="index", columns=NUTRIENT_FIELDS + ["count"])
+    df = df.fillna(0)
+    df["date"] = pd.to_datetime(df.index).date
+    return df.sort_values("date").reset_index(drop=True)
+
+
+# ——— 1e) Per-request snapshots ———
+class TableSnapshot:
+    """Tables read for one request. Each table (or patient slice of a log
+    table) is loaded once and reused, so every part of a combined response is
+    computed from the same data."""
+
+    def __init__(self):
+        self._records: Dict[str, List[Dict[str, Any]]] = {}
+        self._patient_frames: Dict[Any, pd.DataFrame] = {}
+
+    def records(self, table_name: str) -> List[Dict[str, Any]]:
+        if table_name not in self._records:
+            self._records[table_name] = load_records(table_name)
+        return self._records[table_name]
+
+    def frame(self, table_name: str) -> pd.DataFrame:
+        return pd.DataFrame(self.records(table_name))
+
+    def patient_frame(self, table_name: str, patient_ids) -> pd.DataFrame:
+        key = (table_name, tuple(patient_key(p) for p in patient_ids))
+        if key not in self._patient_frames:
+            self._patient_frames[key] = load_patient_frame(table_name, list(patient_ids))
+        return self._patient_frames[key].copy()
+
+    def doctor_patients(self, drid: int) -> List[Any]:
+        df = self.frame("dr_table")
+        df = df[df["DrID"] == drid]
+        return [x for x in df.iloc[0]["PatientIDs"] or [] if x is not None]
+
+    def last_activity(self, patient_ids) -> pd.Series:
+        """Latest diet or exercise log time per patient (NaT when there is none).
+
+        Read from the last-activity view the table cache maintains on every log
+        write; for tables that aren't cached it is computed from the snapshot.
+        """
+        per_table = []
+        for table_name in ("diet_logs", "exercise"):
+            latest = table_cache.get_latest(table_name, patient_ids)
+            if latest is None:
+                df = self.patient_frame(table_name, patient_ids)
+                latest = latest_by_patient(df.to_dict(orient="records"), DATE_FIELDS[table_name])
+            per_table.append(pd.Series(latest, dtype="datetime64[ns]"))
+
+        ids = list(dict.fromkeys(patient_key(p) for p in patient_ids))
+        return pd.concat(per_table, axis=1).max(axis=1).reindex(ids)
+
+
+def with_last_activity(df: pd.DataFrame, column: str,
+                       snapshot: Optional[TableSnapshot] = None) -> pd.DataFrame:
+    """Add the last-activity time of each row's patient as `column`."""
+    latest = (snapshot or TableSnapshot()).last_activity(df["PatientID"].tolist())
+    values = df["PatientID"].map(patient_key).map(latest)
+    df[column] = values.astype(object).where(values.notna(), None)
+    return df
+
 
 # ——— 2) Define request model ———
 class LoginRequest(BaseModel):
@@ -60,17 +969,10 @@ class LoginRequest(BaseModel):
 
 
 @app.post("/login_doctor")
-async def login_doctor(req: LoginRequest):
+@runs_on("firebase")
+def login_doctor(req: LoginRequest):
     # 3a) Fetch patient_table
-    table_ref = db.reference('dr_table')
-    raw = table_ref.get()
-
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
+    records = load_records("dr_table")
 
     # 3) Turn into DataFrame
     df = pd.DataFrame(records)
@@ -93,16 +995,9 @@ class SignupRequestDoctor(BaseModel):
 
 
 @app.post("/signup_doctor")
-async def signup_doctor(req: SignupRequestDoctor):
-    table_ref = db.reference('dr_table')
-    raw = table_ref.get()
-
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
+@runs_on("firebase")
+def signup_doctor(req: SignupRequestDoctor):
+    records = load_records("dr_table")
 
     # 3) Turn into DataFrame
     df = pd.DataFrame(records)
@@ -119,132 +1014,88 @@ async def signup_doctor(req: SignupRequestDoctor):
         "DrID":dr_id
     }
 
-    table_ref.push(new_dr)
+    push_record("dr_table", new_dr)
     return {"success": True, "message": "Doctor registered successfully!"}
 
 
-@app.get("/get_total_log_entries")
-async def get_total_log_entries(drid: int = Query(...)):
-    raw = db.reference("dr_table").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-
-    df = pd.DataFrame(records)
-    df = df[df["DrID"] == drid]
-    patients = df.iloc[0]["PatientIDs"]
+def total_log_entries(snapshot: TableSnapshot, drid: int) -> int:
+    patients = snapshot.doctor_patients(drid)
     print(patients)
 
-    raw = db.reference("diet_logs").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-
-    df2 = pd.DataFrame(records)
-    df2 = df2[df2["PatientID"].isin(patients)]
-    print(df2)
+    df2 = snapshot.patient_frame("diet_logs", patients)
     total_diet_logs = df2.shape[0]
 
-    raw = db.reference("steps_table").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-    df3 = pd.DataFrame(records)
-    df3 = df3[df3["PatientID"].isin(patients)]
-    print(df3)
+    df3 = snapshot.patient_frame("steps_table", patients)
     total_exercise_logs = df3.shape[0]
 
-    total_logs = total_diet_logs + total_exercise_logs
-    
-    return {"Total Log Entries":total_logs}
+    return total_diet_logs + total_exercise_logs
 
-@app.get("/get_latest_log_entries")
-async def get_latest_log_entries(drid: int = Query(...)):
-    raw = db.reference("dr_table").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
 
-    df = pd.DataFrame(records)
-    df = df[df["DrID"] == drid]
-    patients = df.iloc[0]["PatientIDs"]
-    print(patients)
+def latest_log_entries(snapshot: TableSnapshot, drid: int, n: int = 4) -> List[Dict[str, Any]]:
+    patients = snapshot.doctor_patients(drid)
 
-    raw = db.reference("diet_logs").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-
-    df2 = pd.DataFrame(records)
-    df2 = df2[df2["PatientID"].isin(patients)]
+    df2 = snapshot.patient_frame("diet_logs", patients)
     df2["datetime"]= pd.to_datetime(df2["datetime"])
 
-    # Grab the 4 rows with the largest datetime values
+    # Grab the n rows with the largest datetime values
+    top = df2.nlargest(n, "datetime")
 
-    top4 = df2.nlargest(4, "datetime")
+    df3 = snapshot.frame("patient_table")
+    df3=df3[["PatientID","PatientName"]]
 
-    #print(top4)
+    df_merged = pd.merge(top,df3,how='inner')
+    return df_merged.to_dict(orient="records")
 
-    raw = db.reference("patient_table").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
 
-    df3 = pd.DataFrame(records)
-    df3=df3[["PatientID","PatientName"]]
-    
+def patient_roster(snapshot: TableSnapshot, drid: int) -> List[Dict[str, Any]]:
+    patients = snapshot.doctor_patients(drid)
 
-    df_merged = pd.merge(top4,df3,how='inner')
-    #print(df_merged)
+    df2 = snapshot.frame("patient_table")
+    df2 = df2[df2["PatientID"].isin(patients)].copy()
 
-    return df_merged.to_dict(orient="records")
+    # Latest diet or exercise log of each patient, for the whole roster at once
+    df2 = with_last_activity(df2, "Last_Activity", snapshot)
 
+    return df2.to_dict(orient="records")
 
 
-@app.get("/get_diet_logs")
-async def get_diet_logs(patientid: int = Query(...)):
-    raw = db.reference("diet_logs").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
+@app.get("/get_total_log_entries")
+@runs_on("firebase")
+def get_total_log_entries(drid: int = Query(...)):
+    total_logs = total_log_entries(TableSnapshot(), drid)
+    return {"Total Log Entries":total_logs}
 
-    df = pd.DataFrame(records)
-    df = df[df["PatientID"] == patientid]
+@app.get("/get_latest_log_entries")
+@runs_on("firebase")
+def get_latest_log_entries(drid: int = Query(...)):
+    return latest_log_entries(TableSnapshot(), drid)
+
+
+@app.get("/get_dr_dashboard_summary")
+@runs_on("firebase")
+def get_dr_dashboard_summary(drid: int = Query(...), latest: int = Query(4)):
+    """Everything the dashboard landing page needs, from one snapshot:
+    the doctor's log totals, latest `latest` diet logs and patient roster."""
+    snapshot = TableSnapshot()
+    return {
+        "Total Log Entries": total_log_entries(snapshot, drid),
+        "latest_logs": latest_log_entries(snapshot, drid, latest),
+        "patients": patient_roster(snapshot, drid),
+    }
+
+
+
+@app.get("/get_diet_logs")
+@runs_on("firebase")
+def get_diet_logs(patientid: int = Query(...)):
+    df = load_patient_frame("diet_logs", patientid)
     return df.to_dict(orient="records")
 
 
 @app.get("/get_exercise_logs")
-async def get_exercise_logs(patientid: int = Query(...)):
-    raw = db.reference("exercise").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-    df = pd.DataFrame(records)
-    df = df[df["PatientID"] == patientid]
+@runs_on("firebase")
+def get_exercise_logs(patientid: int = Query(...)):
+    df = load_patient_frame("exercise", patientid)
     return df.to_dict(orient="records")
 
 
@@ -258,9 +1109,8 @@ class dietplaninput(BaseModel):
     Notes: str
 
 @app.post("/post_diet_plan")
-async def post_diet_plan(req: dietplaninput):
-    table_ref = db.reference('diet_plan_settings')
-    #raw = table_ref.get()
+@runs_on("firebase")
+def post_diet_plan(req: dietplaninput):
     new_diet_plan = {
         "PatientID":req.patientid,
         "Target_Daily_Calories":req.targetdailycalories,
@@ -270,15 +1120,14 @@ async def post_diet_plan(req: dietplaninput):
         "Notes": req.Notes
     }
 
-    table_ref.push(new_diet_plan)
+    push_record("diet_plan_settings", new_diet_plan)
     return {"success": True, "message": "New Diet Plan Updated"}
 
 @app.put("/update_diet_plan")
-async def upsert_diet_plan(req: dietplaninput):
-    ref = db.reference('diet_plan_settings')
-
+@runs_on("firebase")
+def upsert_diet_plan(req: dietplaninput):
     # 1) Pull down all entries
-    all_plans = ref.get() or {}
+    all_plans = load_table("diet_plan_settings")
 
     # 2) Find the key for this patient, if it exists
     matching_key = None
@@ -301,126 +1150,46 @@ async def upsert_diet_plan(req: dietplaninput):
     # 4) Update if found, otherwise push new
     try:
         if matching_key:
-            ref.child(matching_key).update(data_to_write)
+            update_record("diet_plan_settings", matching_key, data_to_write)
             return {"success": True, "message": "Diet plan updated for patient"}
         else:
-            ref.push(data_to_write)
+            push_record("diet_plan_settings", data_to_write)
             return {"success": True, "message": "Diet plan created for patient"}
     except Exception as e:
         # Wrap any Firebase errors in a 500
         raise HTTPException(status_code=500, detail=f"Firebase error: {e}")
 
 @app.get("/get_diet_plan")
-async def get_diet_plan(patientid: int = Query(...)):
-    raw = db.reference("diet_plan_settings").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-
-    df = pd.DataFrame(records)
-    df = df[df["PatientID"] == patientid]
+@runs_on("firebase")
+def get_diet_plan(patientid: int = Query(...)):
+    df = load_patient_frame("diet_plan_settings", patientid)
     return df.to_dict(orient="records")
 
 
 
 @app.get("/get_patient_dr")
-async def get_patient_by_drid(drid: int = Query(...)):
-    raw = db.reference("dr_table").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-
-    df = pd.DataFrame(records)
-    df = df[df["DrID"] == drid]
-    patients = df.iloc[0]["PatientIDs"]
-
-    raw2 = db.reference("patient_table").get()
-
-    if isinstance(raw2, dict):
-        records2 = list(raw2.values())
-    elif isinstance(raw2, list):
-        records2 = raw2
-    else:
-        records2 = []
-
-
-    df2 = pd.DataFrame(records2)
-    df2 = df2[df2["PatientID"].isin(patients)]
-
-    latest_log_arr = []
-    for i in range (len(df2)):
-        patient_id = df2.iloc[i]["PatientID"]
-        diet_log = db.reference('diet_logs')
-        raw = diet_log.get()
-        # 2) Normalize into a list of dicts
-        if isinstance(raw, dict):
-            records = list(raw.values())
-        elif isinstance(raw, list):
-            records = raw
-        else:
-            records = []
-
-        # 3) Turn into DataFrame
-        df_dietlog = pd.DataFrame(records)
-        df_dietlog = df_dietlog[df_dietlog["PatientID"]==patient_id]
-        df_dietlog["datetime"]= pd.to_datetime(df_dietlog["datetime"])
-        latest_log_diet  = df_dietlog["datetime"].max()
-
-        exercise_log = db.reference('exercise')
-        raw = exercise_log.get()
-        # 2) Normalize into a list of dicts
-        if isinstance(raw, dict):
-            records = list(raw.values())
-        elif isinstance(raw, list):
-            records = raw
-        else:
-            records = []
-
-        df_exerciselog = pd.DataFrame(records)
-        df_exerciselog = df_exerciselog[df_exerciselog["PatientID"]==patient_id]
-        df_exerciselog["Datetime"]= pd.to_datetime(df_exerciselog["Datetime"])
-        latest_log_exercise  = df_exerciselog["Datetime"].max()
-
-        if(latest_log_diet>latest_log_exercise):
-            latest_log_arr.append(latest_log_diet)
-        else:
-            latest_log_arr.append(latest_log_exercise) 
-
-    df2["Last_Activity"]=latest_log_diet
-
-    return df2.to_dict(orient="records")
+@runs_on("firebase")
+def get_patient_by_drid(drid: int = Query(...)):
+    return patient_roster(TableSnapshot(), drid)
 
 
 
 @app.get("/get_average_nutrients")
-async def get_average_nutrients(patientid: int = Query(...)):
-    raw = db.reference("diet_logs").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-
-    df = pd.DataFrame(records)
-    df['datetime'] = pd.to_datetime(df['datetime'])
-    df['date'] = df['datetime'].dt.date
-    df = df[df["PatientID"] == patientid]
+@runs_on("firebase")
+def get_average_nutrients(patientid: int = Query(...)):
+    df = load_daily_rollup(patientid)
 
-    days = len(df["date"].unique())
+    days = len(df)
 
     print(days)
 
-    avg_calorie = df["calorie_intake"].sum()/days
-    avg_fat = df["fat_intake"].sum()/days
-    avg_sodium = df["sodium_intake"].sum()/days
-    avg_sugar = df["sugar_intake"].sum()/days
+    if days == 0:
+        avg_calorie = avg_fat = avg_sodium = avg_sugar = 0.0
+    else:
+        avg_calorie = df["calorie_intake"].sum()/days
+        avg_fat = df["fat_intake"].sum()/days
+        avg_sodium = df["sodium_intake"].sum()/days
+        avg_sugar = df["sugar_intake"].sum()/days
 
     result = {
     "avg_calorie(kcal)": round(float(avg_calorie),2) if not pd.isna(avg_calorie) else 0.0,
@@ -432,27 +1201,17 @@ async def get_average_nutrients(patientid: int = Query(...)):
     return result
 
 @app.get("/get_nutrient_trend")
-async def get_nutrient_trend(patientid: int = Query(...)):
-    raw = db.reference("diet_logs").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-    df = pd.DataFrame(records)
-    df = df[df["PatientID"] == patientid]
-    df['datetime'] = pd.to_datetime(df['datetime'])
-    df['date'] = df['datetime'].dt.date
+@runs_on("firebase")
+def get_nutrient_trend(patientid: int = Query(...)):
+    df = load_daily_rollup(patientid)
     print(df)
-    grouped_by_df = df.groupby('date')[[
-    'sodium_intake',
-    'sugar_intake',
-    'fat_intake',
-    'calorie_intake'
-    ]].mean()
 
-    trend = grouped_by_df.reset_index().to_dict(orient='records')
+    # Daily mean per entry = daily total / number of entries that day
+    grouped_by_df = df[['date']].copy()
+    for col in ['sodium_intake', 'sugar_intake', 'fat_intake', 'calorie_intake']:
+        grouped_by_df[col] = df[col] / df['count']
+
+    trend = grouped_by_df.to_dict(orient='records')
 
     return {
         "patientid": patientid,
@@ -462,16 +1221,9 @@ async def get_nutrient_trend(patientid: int = Query(...)):
 
 
 @app.get("/get_steps")
-async def get_steps(patientid: int = Query(...)):
-    raw = db.reference("steps_table").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-    df = pd.DataFrame(records)
-    df = df[df["PatientID"] == patientid]
+@runs_on("firebase")
+def get_steps(patientid: int = Query(...)):
+    df = load_patient_frame("steps_table", patientid)
 
     df["Calories_Burned"] = df["NumberOfSteps"].apply(estimate_calories_burned)
 
@@ -482,16 +1234,9 @@ async def get_steps(patientid: int = Query(...)):
     return df.to_dict(orient="records")
 
 @app.get("/get_steps_phone")
-async def get_steps_phone(patientid: int = Query(...)):
-    raw = db.reference("steps_table").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-    df = pd.DataFrame(records)
-    df = df[df["PatientID"] == patientid]
+@runs_on("firebase")
+def get_steps_phone(patientid: int = Query(...)):
+    df = load_patient_frame("steps_table", patientid)
     df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
     df['day'] = df['Date'].dt.day_name()
     
@@ -505,122 +1250,156 @@ async def get_steps_phone(patientid: int = Query(...)):
     return df.to_dict(orient="records")
 
 
-gemini_api_key = os.getenv("GEMINI_API_KEY")
+def init_gemini():
+    import google.generativeai as genai
 
-genai.configure(api_key=gemini_api_key)
+    load_dotenv(dotenv_path="api_keys.env")
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+    # For text-only chat
+    return genai.GenerativeModel('gemini-2.0-flash')
 
-# --- Initialize Gemini Models ---
-# For text-only chat
-text_model = genai.GenerativeModel('gemini-2.0-flash')
-chat_session = text_model.start_chat(history=[]) # Maintain chat history for context
 
-class ImageAIResponse(BaseModel):
-    message: str
-    original_filename: str
+text_model = register_subsystem("gemini", init_gemini)
 
-@app.post("/upload-image")
-async def upload_image(
-    dt_string : str,
-    patientid : int,
-    file: UploadFile = File(...)
-    #prompt: str = Form("Analyze the image and format answer in the following json format:Food,calories(kcal), fat(g), sodium(g), sugar(g)") # Optional prompt from frontend
-):
-    try:
-        #print(f"Received image: {file.filename}, prompt: {prompt}")
-        load_dotenv(dotenv_path="api_keys.env")
-        imgur_api_key = os.getenv("IMGUR_CLIENT_ID")
-        IMGUR_CLIENT_ID = imgur_api_key
-        IMGUR_UPLOAD_ENDPOINT = "https://api.imgur.com/3/image"
+# One chat per patient, with bounded history (see chat_sessions.py)
+chat_sessions = ChatSessionManager(
+    lambda history: text_model.get().start_chat(history=history),
+    max_turns=int(os.getenv("CHAT_SESSION_MAX_TURNS", "10")),
+    max_tokens=int(os.getenv("CHAT_SESSION_MAX_TOKENS", "8000")),
+    idle_seconds=float(os.getenv("CHAT_SESSION_IDLE_SECONDS", "1800")),
+    max_sessions=int(os.getenv("CHAT_SESSION_MAX_SESSIONS", "1000")),
+    max_bytes=int(float(os.getenv("CHAT_SESSION_MAX_MB", "256")) * 1024 * 1024),
+)
 
-        contents = await file.read()
-        
-        # Prepare image for Gemini Vision
-        img = PIL.Image.open(io.BytesIO(contents))
 
-        prompt = f"""
-            Analyze the image and format answer in the following json format:
-            Food,calories(kcal), fat(g), sodium(g), sugar(g)
-            your response should only be the json and nothing else
+# Call these through run_blocking, so a model that is still loading is waited
+# for on a worker thread rather than on the event loop
+def gemini_generate(*args, **kwargs):
+    return text_model.get().generate_content(*args, **kwargs)
 
-        """
-        
-        prompt_parts = [prompt, img]
-
-        response = text_model.generate_content(prompt_parts)
-        answer = response.text
-        answer = re.sub(r'```json', '', answer)
-        answer = re.sub(r'```', '', answer)
-        answer_json = json.loads(answer)
-        #print(f"{answer_json}")
-
-        headers = {"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"}
-        resp = requests.post(
-            IMGUR_UPLOAD_ENDPOINT,
-            headers=headers,
-            files={"image": contents}
-        )
-        resp.raise_for_status()
-        image_link = resp.json()["data"]["link"]
-        answer_json["image_link"] = image_link
 
-        #now = datetime.now()
-        #dt_string = now.strftime("%Y-%m-%d %H:%M:%S") 
+def gemini_chat(patientid: int, content_parts):
+    return chat_sessions.send(patientid, content_parts)
 
-        table_ref = db.reference('diet_logs')
-        raw = table_ref.get()
-        
-        new_diet_log = {
-            "PatientID":patientid,
-            "calorie_intake":answer_json["calories(kcal)"],
-            "datetime":dt_string,
-            "fat_intake":answer_json["fat(g)"],
-            "imagelink":image_link,
-            "notes":answer_json["Food"],
-            "sodium_intake":answer_json["sodium(g)"],
-            "sugar_intake":answer_json["sugar(g)"]
-        }
 
-        table_ref.push(new_diet_log)
+def chunk_text(chunk) -> str:
+    """Text of one streamed response chunk; "" for chunks without any (the
+    final chunk of a blocked response, for example)."""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+# ——— Structured output for the food analysis prompts ———
+# The analysis calls use Gemini's JSON mode with a response schema, and the
+# answer is validated against the matching pydantic model. A malformed answer
+# gets one repair round trip (text only, no image) instead of failing the
+# upload and making the patient send the photo again.
+class MealIngredients(BaseModel):
+    Food_Name: str
+    Ingredients: List[str]
+
+
+class MealNutrients(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    Food: str
+    calories: Optional[float] = Field(0, alias="calories(kcal)")
+    fat: Optional[float] = Field(0, alias="fat(g)")
+    sodium: Optional[float] = Field(0, alias="sodium(g)")
+    sugar: Optional[float] = Field(0, alias="sugar(g)")
+
+    def to_answer(self) -> Dict[str, Any]:
+        # "Not a food item" answers may come back with nulls; the app expects numbers
+        return {k: (0 if v is None else v) for k, v in self.model_dump(by_alias=True).items()}
+
+
+MEAL_INGREDIENTS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "Food_Name": {"type": "STRING"},
+        "Ingredients": {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": ["Food_Name", "Ingredients"],
+}
+
+MEAL_NUTRIENTS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "Food": {"type": "STRING"},
+        "calories(kcal)": {"type": "NUMBER"},
+        "fat(g)": {"type": "NUMBER"},
+        "sodium(g)": {"type": "NUMBER"},
+        "sugar(g)": {"type": "NUMBER"},
+    },
+    "required": ["Food", "calories(kcal)", "fat(g)", "sodium(g)", "sugar(g)"],
+}
+
+
+class AIOutputError(ValueError):
+    pass
+
+
+def parse_model_output(text: str, model_cls):
+    text = re.sub(r"```(?:json)?", "", text or "").strip()
+    return model_cls.model_validate_json(text)
+
+
+async def generate_structured(prompt_parts: list, schema: dict, model_cls):
+    """Run a Gemini call in JSON mode and validate the answer as `model_cls`,
+    with one repair attempt. Raises AIOutputError if both answers are invalid."""
+    generation_config = {"response_mime_type": "application/json", "response_schema": schema}
+    response = await run_blocking(
+        "gemini", gemini_generate, prompt_parts, generation_config=generation_config
+    )
+    text = response.text  # raises for blocked prompts, which the handlers report
+    try:
+        return parse_model_output(text, model_cls)
+    except ValueError as e:  # includes pydantic's ValidationError
+        print(f"Invalid structured answer from Gemini, repairing: {e}")
+        instructions = "\n".join(part for part in prompt_parts if isinstance(part, str))
+        repair_prompt = f"""
+        Your previous answer to the instructions below did not match the required JSON schema.
+        Error: {e}
+        Previous answer: {text}
+        Instructions: {instructions}
+        Return only the corrected JSON.
+        """
 
-        return answer_json
-    
-    except Exception as e:
-        print(f"Error during image processing: {e}")
-        if hasattr(e, 'prompt_feedback') and e.prompt_feedback.block_reason:
-             return ImageAIResponse(message=f"Content blocked: {e.prompt_feedback.block_reason.name}", original_filename=file.filename or "unknown")
-        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
-    
+    response = await run_blocking(
+        "gemini", gemini_generate, repair_prompt, generation_config=generation_config
+    )
+    text = response.text
+    try:
+        return parse_model_output(text, model_cls)
+    except ValueError as e:
+        raise AIOutputError(f"AI model returned invalid JSON. Response: {text}") from e
 
-@app.get("/get_nutrient_trend_phone_week")
-async def get_nutrient_trend_phone_week(patientid: int = Query(...)):
-    # 1) Fetch raw diet logs
-    raw = db.reference("diet_logs").get() or {}
-    records = list(raw.values()) if isinstance(raw, dict) else raw
 
-    # 2) Build DataFrame and filter by patient
-    df = pd.DataFrame(records)
-    df = df[df["PatientID"] == patientid]
-    df['datetime'] = pd.to_datetime(df['datetime'], errors='coerce')
-    df['day'] = df['datetime'].dt.day_name()
-    df['date'] = df['datetime'].dt.date
+@app.get("/get_nutrient_trend_phone_week")
+@runs_on("firebase")
+def get_nutrient_trend_phone_week(patientid: int = Query(...)):
+    # 1) Fetch this patient's daily nutrient totals
+    df = load_daily_rollup(patientid)
 
-    # 3) Compute date range: from 6 days ago up to today
+    # 2) Compute date range: from 6 days ago up to today
     today = datetime.now().date()
     seven_days_ago = today - timedelta(days=6)
 
-    # 4) Filter DataFrame to the past 7 days
+    # 3) Filter to the past 7 days
     mask = (df['date'] >= seven_days_ago) & (df['date'] <= today)
     week_df = df.loc[mask]
 
-    # 5) Group by date and sum each nutrient
-    grouped = week_df.groupby('date')[
-        ['sodium_intake', 'sugar_intake', 'fat_intake', 'calorie_intake']
-    ].sum().round(2).reset_index()
+    # 4) Daily sums of each nutrient
+    grouped = week_df[
+        ['date', 'sodium_intake', 'sugar_intake', 'fat_intake', 'calorie_intake']
+    ].round(2).reset_index(drop=True)
 
-    # 6) Add day name column
+    # 5) Add day name column
     grouped['day'] = pd.to_datetime(grouped['date']).dt.day_name()
 
-    # 7) Convert to list-of-dicts for JSON
+    # 6) Convert to list-of-dicts for JSON
     trend_list = grouped.to_dict(orient='records')
 
     return {
@@ -636,52 +1415,79 @@ class stepsinput(BaseModel):
     steps:int
 
 @app.post("/post_steps")
-async def post_steps(req: stepsinput):
-    table_ref = db.reference('steps_table')
-    #raw = table_ref.get()
+@runs_on("firebase")
+def post_steps(req: stepsinput):
     new_steps = {
         "Date":req.date,
         "NumberOfSteps":req.steps,
         "PatientID":req.patientid
     }
 
-    table_ref.push(new_steps)
+    push_record("steps_table", new_steps)
     return {"success": True, "message": "New Steps Added"}
 
 
-def get_df(table_name:str, dr_id:int):
-    table_ref = db.reference(table_name)
-    raw = table_ref.get()
-    # 2) Normalize into a list of dicts
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-
-    # 3) Turn into DataFrame
-    df = pd.DataFrame(records)
-    
-    if (table_name == "dr_table"):
-        df = df[df["DrID"]==dr_id]
-    else:
-        table_ref = db.reference("dr_table")
-        raw = table_ref.get()
-        if isinstance(raw, dict):
-            records = list(raw.values())
-        elif isinstance(raw, list):
-            records = raw
+# Column types the chatbot prompt promises the generated code. Parsing them once
+# per snapshot saves every generated snippet its own pd.to_datetime calls.
+CHATBOT_DATETIME_COLUMNS = {
+    "patient_table": ["DateOfBirth"],
+    "diet_logs": ["datetime"],
+    "steps_table": ["Date"],
+}
+CHATBOT_NUMERIC_COLUMNS = {
+    "patient_table": ["Age", "PatientID"],
+    "diet_plan_settings": ["Max_Fat", "Max_Sodium", "Max_Sugar", "PatientID", "Target_Daily_Calories"],
+    "diet_logs": ["PatientID", "calorie_intake", "fat_intake", "sodium_intake", "sugar_intake"],
+    "steps_table": ["NumberOfSteps", "PatientID"],
+}
+
+
+class DoctorSnapshot:
+    """One doctor's tables for a single /chat_bot_dr request. The doctor's
+    PatientIDs are resolved once, and each table is loaded and typed at most
+    once, however many times (or runs of generated code) ask for it. The frames
+    are treated as read-only: the code runner hands out views of them."""
+
+    def __init__(self, dr_id: int):
+        self.dr_id = dr_id
+        self._patients: Optional[List[int]] = None
+        self._tables: Dict[str, pd.DataFrame] = {}
+
+    def patients(self) -> List[int]:
+        if self._patients is None:
+            dr_rows = [r for r in load_records("dr_table") if r.get("DrID") == self.dr_id]
+            patients = (dr_rows[0].get("PatientIDs") or []) if dr_rows else []
+            self._patients = [x for x in patients if x is not None]
+        return self._patients
+
+    def _load(self, table_name: str) -> pd.DataFrame:
+        if table_name == "dr_table":
+            df = pd.DataFrame(load_records(table_name))
+            return df[df["DrID"] == self.dr_id].reset_index(drop=True)
+
+        patients = self.patients()
+        if table_name in INDEXED_TABLES:
+            df = load_patient_frame(table_name, patients)
         else:
-            records = []
-        dr_table = pd.DataFrame(records)
-        dr_table = dr_table[dr_table["DrID"]==dr_id]
-        patients = dr_table.iloc[0]["PatientIDs"]
-        patients = [x for x in patients if x is not None]
-        df = df[df["PatientID"].isin(patients)]
-
-        
-    return df
+            df = pd.DataFrame(load_records(table_name))
+            df = df[df["PatientID"].isin(patients)]
+        df = df.reset_index(drop=True)
+
+        for column in CHATBOT_DATETIME_COLUMNS.get(table_name, []):
+            if column in df:
+                df[column] = pd.to_datetime(df[column], errors="coerce")
+        for column in CHATBOT_NUMERIC_COLUMNS.get(table_name, []):
+            if column in df:
+                df[column] = pd.to_numeric(df[column], errors="coerce")
+        return df
+
+    def table(self, table_name: str) -> pd.DataFrame:
+        if table_name not in self._tables:
+            self._tables[table_name] = self._load(table_name)
+        return self._tables[table_name]
+
+    def tables(self, table_names) -> Dict[str, pd.DataFrame]:
+        return {name: self.table(name) for name in table_names}
 
 FORBIDDEN_NAMES = { "sys", "subprocess", "shutil", "__import__"}
 
@@ -708,8 +1514,18 @@ def is_code_safe(code: str) -> bool:
 
     return True
 
+def init_openai():
+    import openai
+
+    load_dotenv(dotenv_path="api_keys.env")
+    return openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+openai_client = register_subsystem("openai", init_openai)
+
+
 def get_ai_reply(query):
-    response = openai.chat.completions.create(
+    response = openai_client.get().chat.completions.create(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "You are a helpful assistant."},
@@ -720,34 +1536,102 @@ def get_ai_reply(query):
 
     return response.choices[0].message.content
 
-from fastapi.responses import FileResponse, JSONResponse
-import openai
-from dotenv import load_dotenv
-import os
-import re
-import google.generativeai as genai
-
 class ChatBotDrRequest(BaseModel):
     dr_id: int
     question: str
+    session_id: Optional[str] = None  # separate conversations for one doctor
 
-@app.post("/chat_bot_dr")
-def chat_bot_dr(request_data: ChatBotDrRequest):
 
-    dr_id = request_data.dr_id          # Access from parsed body
-    question = request_data.question 
-    # Load API key from custom env file
-    load_dotenv(dotenv_path="api_keys.env")
-    api_key = os.getenv("OPENAI_API_KEY")
+# ——— Conversation memory for /chat_bot_dr ———
+# Each doctor (and session) has its own history, kept under a token budget by
+# summarizing older turns (conversation_memory.py), instead of one shared and
+# ever-growing AI_memory.txt in every prompt.
+def summarize_conversation(summary: str, turns) -> str:
+    conversation = "".join(f"Question: {q}\nAnswer: {a}\n" for q, a in turns)
+    prompt = f"""
+    Summarize this conversation between a doctor and their data assistant so it can be continued later.
+    Keep patient names and IDs, dates, numbers and what the doctor was interested in; drop pleasantries.
+    Answer with the summary only, in at most 150 words.
 
-    with open("AI_memory.txt", "r") as file:
-        history = file.read()
+    Summary so far: {summary or "(none)"}
 
-    # Check if API key was loaded
-    if not api_key:
-        raise ValueError("openai not found in api_keys.env")
+    New turns:
+    {conversation}
+    """
+    return gemini_generate(prompt).text.strip()
 
-    prompt = f"""
+
+chat_memory = conversation_memory_from_env(summarize_conversation)
+
+
+@app.on_event("shutdown")
+def close_chat_memory():
+    chat_memory.close()
+
+# ——— Sandboxed execution of the generated code ———
+# The code runs in a pool of worker processes (code_runner.py) with CPU, memory
+# and wall-clock limits, so a runaway groupby or an endless loop only costs its
+# own worker. The tables it asks for are loaded here, scoped to the doctor, and
+# sent to the worker with the code.
+CHATBOT_TABLES = ("patient_table", "diet_plan_settings", "diet_logs", "steps_table")
+
+
+def init_code_runner():
+    runner = CodeRunner(
+        workers=int(os.getenv("CODE_RUNNER_WORKERS", str(BACKEND_WORKERS["analytics"]))),
+        cpu_seconds=float(os.getenv("CODE_RUNNER_CPU_SECONDS", "20")),
+        memory_mb=int(os.getenv("CODE_RUNNER_MEMORY_MB", "2048")),
+        timeout=float(os.getenv("CODE_RUNNER_TIMEOUT_SECONDS", "30")),
+        warm_render=os.getenv("CODE_RUNNER_WARM_RENDER", "1") == "1",
+    )
+    runner.warm_up()
+    return runner
+
+
+code_runner = register_subsystem("code_runner", init_code_runner)
+
+
+@app.on_event("shutdown")
+def stop_code_runner():
+    if code_runner.loaded:
+        code_runner.get().shutdown()
+
+
+def run_generated_code(code: str, snapshot: DoctorSnapshot):
+    """Execute the generated analysis code against the doctor's `snapshot`.
+    Returns (final_answer, final_graph, ok); ok is False if the code was rejected or failed.
+    final_graph is the chart the code drew as PNG bytes, or None."""
+    Final_Output = "An error occured"
+    Final_Graph = None
+    ok = False
+
+    try:
+        if is_code_safe(code):
+            tables = snapshot.tables(requested_tables(code, CHATBOT_TABLES))
+            answer, graph, error = code_runner.get().run(code, tables)
+            if error is None:
+                Final_Output = answer
+                Final_Graph = graph
+                ok = True
+            else:
+                print(f"Error: {error}")
+        else:
+            print("There is something wrong")
+    except Exception as e:
+        print(f"Error: {e}")
+
+    return Final_Output, Final_Graph, ok
+
+
+# ——— Generated code cache for /chat_bot_dr ———
+# Doctors ask the same questions every day. Code that ran successfully is kept
+# per doctor under the normalized question, the table schema version and a
+# hash of the prompt template, so editing the template (or bumping the schema
+# version when the tables change) invalidates every entry at once. Entries
+# expire after a day by default, so code written against "today" is refreshed.
+CHATBOT_SCHEMA_VERSION = 2
+
+CHATBOT_CODE_PROMPT = """
     You are an assistant that will answer questions based on a dataset, A doctor will ask  you a question regarding it's data
     and your job is to write a python code to answer that question here are the tables
 
@@ -755,7 +1639,7 @@ def chat_bot_dr(request_data: ChatBotDrRequest):
     table name : "patient_table" (this is the table showing the info for each patient)
     the columns are:
     Age                 int64 
-    DateOfBirth        object
+    DateOfBirth        datetime64[ns]
     Email              object
     HealthCondition    object
     PatientID           int64
@@ -779,7 +1663,7 @@ def chat_bot_dr(request_data: ChatBotDrRequest):
     the columns are:
     PatientID           int64
     calorie_intake      int64 (in kcal)
-    datetime           object (the date and time the patient eat the food)
+    datetime           datetime64[ns] (the date and time the patient eat the food)
     fat_intake        float64 (in gram)
     imagelink          object (an imgur link to the photo of the food taken)
     notes              object (the name of the food taken)
@@ -789,12 +1673,13 @@ def chat_bot_dr(request_data: ChatBotDrRequest):
 
     table name : "steps_table"
     (this table will contain the daily number of steps that have been taken by each patient, its like a steps log, for each day a new row will be added showing the steps for each patient)
-    Date             object
+    Date             datetime64[ns]
     NumberOfSteps     int64
     PatientID         int64
 
 
     to access these tables just call the function get_df(table_name,dr_id) and this function will return a pandas dataframe
+    the date and datetime columns are already parsed, so you dont need to call pd.to_datetime on them
     the dr_id is always {dr_id}
 
     the table_name is which table you want to access
@@ -807,11 +1692,11 @@ def chat_bot_dr(request_data: ChatBotDrRequest):
     the question that you need to answer is : {question}
 
     the output of your python code should be stored in a variable called final_answer (This final_answer  CANNOT BE A SENTENCE because we cant perform data analysis using a sentence), However, if the question logically results in a list of distinct items (e.g., a list of meals, a list of patients, a list of dates), then `final_answer` SHOULD be a Python list of strings. Each string in the list should be a complete description of one item. For example, if listing meals for a patient, `final_answer` could be `['On 2025-05-05 at 12:00:31, John Doe ate Nasi Lemak.', 'On 2025-05-05 at 21:10:43, John Doe ate Grilled Cheese Sandwich.']`. Do NOT concatenate these into a single string in `final_answer` if they represent distinct list items.
-    but if the question cannot be answered by a single value and needs a graph, draw the graph using matplotlib and store the plt object in a variable called final_graph and store the graph in graph.png and store the dictionary version of the graph in final_answer
+    but if the question cannot be answered by a single value and needs a graph, draw the graph using matplotlib and store the plt object in a variable called final_graph (dont save it to a file, it will be rendered for you) and store the dictionary version of the graph in final_answer
 
     summary :
     If the question can be answered directly without any graph , put the final output in a variable called final_answer and set final_graph as None
-    If the question needs a graph to answer it, draw a graph using matplotlib and store the plt object in a variable called final_graph and store the graph in graph.png (This part is very important) and store the dictonary version of the graph in the variable final_answer, make sure this dictionary version is easy to understand cuz im gonna pass this variable to another llm
+    If the question needs a graph to answer it, draw a graph using matplotlib and store the plt object in a variable called final_graph (This part is very important, dont call plt.show or save it to a file) and store the dictonary version of the graph in the variable final_answer, make sure this dictionary version is easy to understand cuz im gonna pass this variable to another llm
     If the question does not have any relation with the data dont generate a graph, just return None for the final_graph and for final_answer return a string saying "I dont know"
     However, if the question logically results in a list of distinct items (e.g., a list of meals, a list of patients, a list of dates), then `final_answer` SHOULD be a Python list of strings. Each string in the list should be a complete description of one item. For example, if listing meals for a patient, `final_answer` could be `['On 2025-05-05 at 12:00:31, John Doe ate Nasi Lemak.', 'On 2025-05-05 at 21:10:43, John Doe ate Grilled Cheese Sandwich.']`. Do NOT concatenate these into a single string in `final_answer` if they represent distinct list items.
 
@@ -827,48 +1712,128 @@ def chat_bot_dr(request_data: ChatBotDrRequest):
 
     """
 
-    response = get_ai_reply(prompt)
-    code = response
-    code = re.sub(r'```python', '', code)
-    code = re.sub(r'```', '', code)
+CHATBOT_TEMPLATE_HASH = hashlib.sha256(CHATBOT_CODE_PROMPT.encode("utf-8")).hexdigest()[:16]
 
-    Final_Output = "An error occured"
-    Final_Graph = None
+# Questions that refer back to the conversation depend on the chat history,
+# which is part of the prompt but not of the cache key, so they are not cached
+FOLLOW_UP_WORDS = {
+    "it", "its", "that", "those", "these", "them", "they", "their", "he", "she",
+    "him", "her", "his", "same", "again", "previous", "above", "earlier", "also",
+}
 
 
+def normalize_question(question: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", question.lower()).split())
 
-    # Remove code block markers
-    code = re.sub(r'```python', '', code)
-    code = re.sub(r'```', '', code)
 
-    with open("logs.txt", "w",encoding = "utf-8") as f:
-        f.write(code)
+def is_self_contained(question: str) -> bool:
+    return not FOLLOW_UP_WORDS.intersection(normalize_question(question).split())
 
 
-    exec_globals={}
-    try:
-        if is_code_safe(code):
-            exec_globals["get_df"] = get_df
-            exec(code,exec_globals)
-            Final_Output = exec_globals.get('final_answer')
-            Final_Graph = exec_globals.get('final_graph')
-        else:
-            print("There is something wrong")
-    except Exception as e:
-        print(f"Error: {e}")
+def code_cache_key(dr_id: int, question: str):
+    return (dr_id, normalize_question(question), CHATBOT_SCHEMA_VERSION, CHATBOT_TEMPLATE_HASH)
+
+
+class GeneratedCodeCache:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (code, expires)
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, code: str):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (code, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
 
-    api_key = os.getenv("GEMINI_API_KEY")
 
+CHATBOT_CODE_CACHE_ENABLED = os.getenv("CHATBOT_CODE_CACHE_ENABLED", "1") == "1"
+
+generated_code_cache = GeneratedCodeCache(
+    max_entries=int(os.getenv("CHATBOT_CODE_CACHE_MAX_ENTRIES", "1000")),
+    ttl=float(os.getenv("CHATBOT_CODE_CACHE_TTL_SECONDS", "86400")),
+)
+
+
+async def chat_bot_dr_steps(request_data: ChatBotDrRequest, stream_answer: bool = False):
+    """The /chat_bot_dr pipeline as (event, data) pairs: a "stage" event as each
+    step starts, "token" events with the answer as Gemini writes it (only with
+    stream_answer), and finally "done" with the response JSON."""
+
+    dr_id = request_data.dr_id          # Access from parsed body
+    question = request_data.question 
+    # Load API key from custom env file
+    load_dotenv(dotenv_path="api_keys.env")
+    api_key = os.getenv("OPENAI_API_KEY")
+
+    memory_key = chat_memory.key(dr_id, request_data.session_id)
+    history = chat_memory.history(memory_key)
 
     # Check if API key was loaded
     if not api_key:
         raise ValueError("openai not found in api_keys.env")
 
-    # Configure the Gemini API
-    genai.configure(api_key=api_key)
+    # Built once per request; a failed cached run and its regenerated
+    # replacement read the same tables
+    snapshot = DoctorSnapshot(dr_id)
+
+    # Self-contained questions reuse code generated earlier for this doctor;
+    # it runs against fresh data, so only the OpenAI call is skipped
+    cacheable = CHATBOT_CODE_CACHE_ENABLED and is_self_contained(question)
+    cache_key = code_cache_key(dr_id, question) if cacheable else None
+    code = generated_code_cache.get(cache_key) if cache_key else None
+    ok = False
+    if code is not None:
+        yield "stage", {"stage": "execution", "cached": True}
+        # The generated code pulls tables through get_df and runs pandas, so it
+        # gets its own small pool instead of tying up the request handlers
+        Final_Output, Final_Graph, ok = await run_blocking("analytics", run_generated_code, code, snapshot)
+        if not ok:
+            generated_code_cache.discard(cache_key)
+
+    if not ok:
+        yield "stage", {"stage": "codegen"}
+        prompt = CHATBOT_CODE_PROMPT.format(dr_id=dr_id, question=question, history=history)
+        response = await run_blocking("openai", get_ai_reply, prompt)
+        code = response
+
+        # Remove code block markers
+        code = re.sub(r'```python', '', code)
+        code = re.sub(r'```', '', code)
+
+        with open("logs.txt", "w",encoding = "utf-8") as f:
+            f.write(code)
+
+        yield "stage", {"stage": "execution", "cached": False}
+        Final_Output, Final_Graph, ok = await run_blocking("analytics", run_generated_code, code, snapshot)
+        if ok and cache_key:
+            generated_code_cache.put(cache_key, code)
 
-    # Use the Gemini Pro model (text-only)
-    model = genai.GenerativeModel("gemini-2.0-flash")
+    api_key = os.getenv("GEMINI_API_KEY")
+
+
+    # Check if API key was loaded
+    if not api_key:
+        raise ValueError("openai not found in api_keys.env")
 
 
     prompt2 = f"""
@@ -887,106 +1852,191 @@ def chat_bot_dr(request_data: ChatBotDrRequest):
     and if the question is just a standard greeting like "hello" or "hi" just answer normally.
     Do not include the original `Final_Output` in your response if you are reformatting it (e.g., into bullet points).
     """
-    response_gemini = model.generate_content(prompt2)
 
-    with open("AI_memory.txt", "a") as file:
-        file.write(f"""
-        --------------------------
-        Question : {question}
-        Answer : {response_gemini.text}
-        --------------------------
-        """)
+    # The chart upload doesn't depend on the answer text, so it overlaps the Gemini call
+    graph_upload = start_image_upload(Final_Graph, "graph.png") if Final_Graph is not None else None
 
-    # If no graph, return JSON only
-
-    client_id = os.getenv("IMGUR_CLIENT_ID")
-    
-    ada_graph = False
     try:
-        if Final_Graph != None :
-            ada_graph = True
-            # Your Imgur Client ID
-            IMGUR_CLIENT_ID = client_id  # 👈 Your real Client ID
-            # Path to your local image file
-            image_path = 'graph.png'  # 👈 Replace with your image file
-            # Set headers
-            headers = {
-                'Authorization': f'Client-ID {IMGUR_CLIENT_ID}'
-            }
-            with open(image_path, 'rb') as img_file:
-                response = requests.post(
-                    'https://api.imgur.com/3/image',
-                    headers=headers,
-                    files={'image': img_file}
-                )
-            if response.status_code == 200:
-                image_url = response.json()['data']['link']
+        yield "stage", {"stage": "summarization"}
+        if stream_answer:
+            pieces = []
+            async for chunk in iterate_blocking("gemini", gemini_generate, prompt2, stream=True):
+                piece = chunk_text(chunk)
+                if piece:
+                    pieces.append(piece)
+                    yield "token", {"text": piece}
+            answer = "".join(pieces)
+        else:
+            answer = (await run_blocking("gemini", gemini_generate, prompt2)).text
+
+        # May summarize older turns with Gemini, so it runs on that pool
+        await run_blocking("gemini", chat_memory.add_turn, memory_key, question, answer)
+
+        # If no graph, return JSON only
+
+        ada_graph = False
+        if graph_upload is not None:
+            yield "stage", {"stage": "upload"}
+            image_url = await graph_upload
+            if image_url is not None:
+                ada_graph = True
                 print("✅ Image uploaded successfully!")
                 print("Image URL:", image_url)
-            else:
-                print("❌ Upload failed:", response.json())
-                ada_graph = False
-    except :
-        ada_graph = False
-        
+    finally:
+        if graph_upload is not None:
+            graph_upload.cancel()  # no-op once it has been awaited
 
 
     if ada_graph == False:
         response_json ={
-            "text_response" : response_gemini.text,
+            "text_response" : answer,
             "graph_present": ada_graph
         }
     else :
         response_json ={
-            "text_response" : response_gemini.text,
+            "text_response" : answer,
             "graph_present": ada_graph,
             "image_link":image_url
         }
 
     
-    return response_json
+    yield "done", response_json
 
 
+@app.post("/chat_bot_dr")
+async def chat_bot_dr(request_data: ChatBotDrRequest):
+    async for event, data in chat_bot_dr_steps(request_data):
+        if event == "done":
+            response_json = data
+    return response_json
 
-load_dotenv(dotenv_path="api_keys.env")
-gemini_api_key = os.getenv("GEMINI_API_KEY")
 
-genai.configure(api_key=gemini_api_key)
+@app.post("/chat_bot_dr/stream")
+async def chat_bot_dr_stream(request_data: ChatBotDrRequest):
+    """/chat_bot_dr as Server-Sent Events: "stage" events for code generation,
+    execution, summarization and the chart upload as they start, "token" events
+    with the answer as it is written, then "done" with the usual response JSON."""
+    return sse_response(chat_bot_dr_steps(request_data, stream_answer=True))
 
-# --- Initialize Gemini Models ---
-# For text-only chat
-text_model = genai.GenerativeModel("gemini-2.0-flash")
-chat_session = text_model.start_chat(history=[])  # Maintain chat history for context
 
-import zipfile
-import os
 
 # Path to the zip file
 zip_path = "chroma_store.zip"
 
-# Destination folder to extract into
-extract_to = "chroma_store"
+persist_directory = "chroma_store"
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 
-# Make sure the directory exists
-os.makedirs(extract_to, exist_ok=True)
 
-# Extract the zip file
-with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-    zip_ref.extractall(extract_to)
+def init_food_facts():
+    import chromadb
 
-print(f"Extracted to {extract_to}")
+    # Only unpacks the archive when chroma_store/ doesn't already hold it
+    if ensure_extracted(zip_path, persist_directory):
+        print(f"Extracted {zip_path} to {persist_directory}")
+    client = chromadb.PersistentClient(path=persist_directory)
+    return client.get_collection("food_facts")
 
 
-persist_directory = "chroma_store"
+def init_embeddings():
+    # EMBEDDING_BACKEND=onnx swaps in the int8 ONNX Runtime build of the same model
+    return embedding_backend_from_env(EMBEDDING_MODEL)
+
+
+def init_ingredient_cache():
+    collection = food_facts.get()
+    return IngredientCache(
+        max_entries=int(os.getenv("INGREDIENT_CACHE_MAX_ENTRIES", "2000")),
+        path=os.getenv("INGREDIENT_CACHE_PATH") or None,
+        signature=(
+            f"food_facts:{collection.count()}:"
+            f"v{(collection.metadata or {}).get('nutrients_version', 0)}:{EMBEDDING_MODEL}"
+        ),
+    )
+
+
+food_facts = register_subsystem("chroma", init_food_facts)
+embedding_function = register_subsystem("embeddings", init_embeddings)
+ingredient_cache = register_subsystem("ingredient_cache", init_ingredient_cache)
+
+# Largest (squared L2) distance between an ingredient and its food_facts match
+# that still counts as the same food for the local nutrient calculation
+NUTRIENT_MATCH_MAX_DISTANCE = float(os.getenv("NUTRIENT_MATCH_MAX_DISTANCE", "0.5"))
+
 
+@app.on_event("shutdown")
+def save_ingredient_cache():
+    if ingredient_cache.loaded:
+        ingredient_cache.get().save()
 
-client = chromadb.PersistentClient(path=persist_directory)
 
-embedding_function = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+# ——— Ingredient retrieval ———
+def parse_ingredients(answer) -> List[str]:
+    """Ingredient strings ("Milk 100g") from Gemini's answer: the
+    {"Food_Name", "Ingredients"} JSON, a JSON list, or plain comma separated text."""
+    if isinstance(answer, str):
+        text = re.sub(r"```(?:json)?", "", answer).strip()
+        try:
+            answer = json.loads(text)
+        except ValueError:
+            answer = text
+
+    if isinstance(answer, dict):
+        answer = answer.get("Ingredients") or answer.get("ingredients") or []
+    if isinstance(answer, str):
+        answer = re.split(r"[,;\n]", answer)
+
+    ingredients = []
+    for item in answer:
+        item = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", str(item)).strip(" .\"'")
+        if item and item not in ingredients:
+            ingredients.append(item)
+    return ingredients
+
+
+def match_ingredients(ingredients: List[str]) -> List[Optional[tuple]]:
+    """Closest food_facts (document, distance, metadata) for every ingredient,
+    None where nothing matched. Names already in the ingredient cache are
+    answered from it; the rest go through one batched embedding call and one
+    Chroma query instead of one per ingredient."""
+    names = [normalize_ingredient(i) or i.lower() for i in ingredients]
+    cache = ingredient_cache.get()
+    matches = {name: cache.get(name) for name in dict.fromkeys(names)}
+
+    missing = [name for name, match in matches.items() if match is None]
+    if missing:
+        embeddings = embedding_function.get().embed_documents(missing)
+        results = food_facts.get().query(
+            query_embeddings=embeddings,
+            n_results=1,
+            include=["documents", "distances", "metadatas"],
+        )
+        found = {}
+        for name, documents, distances, metadatas in zip(
+            missing, results["documents"], results["distances"], results["metadatas"]
+        ):
+            if documents:
+                found[name] = (documents[0], distances[0], metadatas[0] or {})
+        cache.put_many(found)
+        matches.update(found)
+
+    return [matches.get(name) for name in names]
 
 
-# Define a Chroma vectorstore
-vectorstore = Chroma(client=client, collection_name="food_facts", embedding_function=embedding_function)
+def ingredient_context(matches: List[Optional[tuple]]) -> str:
+    facts = []
+    for match in matches:
+        if match is not None and match[0] not in facts:  # two ingredients can match the same fact
+            facts.append(match[0])
+    return "\n".join(facts)
+
+
+def calculate_meal(food_name, ingredients: List[str], matches) -> Optional[Dict[str, Any]]:
+    """Meal JSON computed from the matches' per-100g metadata, or None when an
+    ingredient has no confident match and the LLM has to estimate it."""
+    totals = calculate_totals(ingredients, matches, NUTRIENT_MATCH_MAX_DISTANCE)
+    if totals is None:
+        return None
+    return {"Food": food_name, **totals}
 
 class ChatMessage(BaseModel):
     message: str  # Text prompt is mandatory
@@ -1020,93 +2070,91 @@ async def root():
     return {"message": "Gemini Chatbot API is running!"}
 
 
-@app.post("/chat", response_model=AIResponse)
-async def handle_chat(chat_message: ChatMessage, patientid:int):
-    try:
-        raw = db.reference("patient_table").get()
-        if isinstance(raw, dict):
-            records = list(raw.values())
-        elif isinstance(raw, list):
-            records = raw
-        else:
-            records = []
+def load_patient_context(patientid: int):
+    records = load_records("patient_table")
 
-        df = pd.DataFrame(records)
-        df=df[df["PatientID"]==patientid]
-        #print(df)
+    df = pd.DataFrame(records)
+    df=df[df["PatientID"]==patientid]
 
-        patient_info_dict = df.to_dict(orient='records')
+    patient_info_dict = df.to_dict(orient='records')
 
-        raw = db.reference("diet_plan_settings").get()
-        if isinstance(raw, dict):
-            records = list(raw.values())
-        elif isinstance(raw, list):
-            records = raw
-        else:
-            records = []
+    df2 = load_patient_frame("diet_plan_settings", patientid)
+    food_limit_dict = df2.to_dict(orient='records')
 
-        df2 = pd.DataFrame(records)
-        df2=df2[df2["PatientID"]==patientid]
-        #print(df2)
+    return patient_info_dict, food_limit_dict
 
-        food_limit_dict = df2.to_dict(orient='records')
 
-        todays_diet_log = await get_today_diet_log(patientid)
+async def build_chat_parts(chat_message: ChatMessage, patientid: int) -> List[Any]:
+    """Persona, the patient's context, their message and optional photo, as
+    the list of parts sent to their Gemini chat session."""
+    patient_info_dict, food_limit_dict = await run_blocking(
+        "firebase", load_patient_context, patientid
+    )
 
-        #print("Yipppppppppppeeeeeeeeeeee")
+    todays_diet_log = await get_today_diet_log(patientid)
 
-        print(f"Received message: '{chat_message.message}'")
-        if chat_message.image_base64 and chat_message.image_mime_type:
-            print(
-                f"Received image of type: {chat_message.image_mime_type} (length: {len(chat_message.image_base64)})"
-            )
+    #print("Yipppppppppppeeeeeeeeeeee")
 
-        # Prepare content for Gemini
-        # Content can be a list of parts (text, image)
-        content_parts: List[Any] = []
-
-        # Text part is mandatory
-        content_parts.append(
-            "Persona: You are a medical assistant AI who only answers medical/dietary based questions. " \
-            "Your mission is to educate everyone of different backgrounds and language on medical/dietary. " \
-            "You are not to explain about anything irrelevant. And you must NOT use bullet points or bold text." \
-            "If the user ask about food, focus on Malaysian food. Then if the user ask on what to eat, reply it based on the user's current health and make it easy for them to understand what they can eat and specify the portion(such as you can eat half plate of rice) " \
-            "Do not make your response too lengthy. Simplify but also keep the important detail in your response and ensure that it is easily understandable. " \
-            "If the user speaks in their own native language, make sure to reply in their language as well" \
-        )
-        content_parts.append(
-            f"""
-            This is some information about the user : {patient_info_dict},
-            ----------------------------------------
-            And this is some limits the doctor has set for the patient for his/her daily meals: {food_limit_dict}
-            -----------------------------------------
-            And this is the some of the patient's realtime information for today : {todays_diet_log}
-            """
+    print(f"Received message: '{chat_message.message}'")
+    if chat_message.image_base64 and chat_message.image_mime_type:
+        print(
+            f"Received image of type: {chat_message.image_mime_type} (length: {len(chat_message.image_base64)})"
         )
 
-        content_parts.append(
-            chat_message.message
-        )  # Gemini SDK can often infer this is text
+    # Prepare content for Gemini
+    # Content can be a list of parts (text, image)
+    content_parts: List[Any] = []
+
+    # Text part is mandatory
+    content_parts.append(
+        "Persona: You are a medical assistant AI who only answers medical/dietary based questions. " \
+        "Your mission is to educate everyone of different backgrounds and language on medical/dietary. " \
+        "You are not to explain about anything irrelevant. And you must NOT use bullet points or bold text." \
+        "If the user ask about food, focus on Malaysian food. Then if the user ask on what to eat, reply it based on the user's current health and make it easy for them to understand what they can eat and specify the portion(such as you can eat half plate of rice) " \
+        "Do not make your response too lengthy. Simplify but also keep the important detail in your response and ensure that it is easily understandable. " \
+        "If the user speaks in their own native language, make sure to reply in their language as well" \
+    )
+    content_parts.append(
+        f"""
+        This is some information about the user : {patient_info_dict},
+        ----------------------------------------
+        And this is some limits the doctor has set for the patient for his/her daily meals: {food_limit_dict}
+        -----------------------------------------
+        And this is the some of the patient's realtime information for today : {todays_diet_log}
+        """
+    )
 
-        # Image part (optional)
-        if chat_message.image_base64 and chat_message.image_mime_type:
-            try:
-                image_bytes = base64.b64decode(chat_message.image_base64)
-                image_part = {
-                    "mime_type": chat_message.image_mime_type,
-                    "data": image_bytes,
-                }
-                content_parts.append(image_part)
-            except base64.binascii.Error as b64_error:
-                print(f"Error decoding base64 image: {b64_error}")
-                raise HTTPException(
-                    status_code=400, detail="Invalid base64 image data."
-                )
-            except Exception as img_e:  # Catch other potential errors with image data
-                print(f"Error processing image part: {img_e}")
-                raise HTTPException(
-                    status_code=400, detail="Could not process image data."
-                )
+    content_parts.append(
+        chat_message.message
+    )  # Gemini SDK can often infer this is text
+
+    # Image part (optional)
+    if chat_message.image_base64 and chat_message.image_mime_type:
+        try:
+            image_bytes = base64.b64decode(chat_message.image_base64)
+            image_part = {
+                "mime_type": chat_message.image_mime_type,
+                "data": image_bytes,
+            }
+            content_parts.append(image_part)
+        except base64.binascii.Error as b64_error:
+            print(f"Error decoding base64 image: {b64_error}")
+            raise HTTPException(
+                status_code=400, detail="Invalid base64 image data."
+            )
+        except Exception as img_e:  # Catch other potential errors with image data
+            print(f"Error processing image part: {img_e}")
+            raise HTTPException(
+                status_code=400, detail="Could not process image data."
+            )
+
+    return content_parts
+
+
+@app.post("/chat", response_model=AIResponse)
+async def handle_chat(chat_message: ChatMessage, patientid:int):
+    try:
+        content_parts = await build_chat_parts(chat_message, patientid)
 
         print(f"Sending to Gemini, content_parts count: {len(content_parts)}")
         # Example structure of content_parts:
@@ -1114,8 +2162,8 @@ async def handle_chat(chat_message: ChatMessage, patientid:int):
         # or just ["Tell me a joke."]
 
         # Send message to Gemini and get response
-        # The `chat_session.send_message` can take a list of parts directly
-        response = chat_session.send_message(content_parts)
+        # The patient's chat session takes the list of parts directly
+        response = await run_blocking("gemini", gemini_chat, patientid, content_parts)
 
         # If you were using gemini-pro-vision for a one-off:
         # response = model_vision.generate_content(content_parts)
@@ -1147,147 +2195,121 @@ async def handle_chat(chat_message: ChatMessage, patientid:int):
         raise HTTPException(status_code=500, detail=detail_message)
 
 
+@app.post("/chat/stream")
+async def handle_chat_stream(chat_message: ChatMessage, patientid: int):
+    """/chat as Server-Sent Events: "token" events with the reply as Gemini
+    writes it, then "done" with the whole message."""
+    # Bad input and missing patients still fail with a plain HTTP error
+    content_parts = await build_chat_parts(chat_message, patientid)
+
+    async def events():
+        pieces = []
+        async for chunk in iterate_blocking("gemini", chat_sessions.stream, patientid, content_parts):
+            piece = chunk_text(chunk)
+            if piece:
+                pieces.append(piece)
+                yield "token", {"text": piece}
+        yield "done", {"message": "".join(pieces)}
+
+    return sse_response(events())
+
+
 @app.post("/upload-image")
 async def upload_image(
     patientid: int = Form(...),  # MODIFIED: Receive patientid as Form data
     file: UploadFile = File(...),
 ):
+    upload_task = None
     try:
-        load_dotenv(dotenv_path="api_keys.env")
-        IMGUR_CLIENT_ID = os.getenv("IMGUR_CLIENT_ID")
-        IMGUR_UPLOAD_ENDPOINT = "https://api.imgur.com/3/image"
-
-        contents = await file.read()
+        contents = await read_upload(file)
         print(f"Received file size: {len(contents)} bytes")
 
-        img = PIL.Image.open(io.BytesIO(contents))
-
-        # Enhanced prompt for more robust JSON
-        prompt = f"""
-            1. Persona: You are nutritionist that help to analyze the food items in the image.
-            2. Identify the dish and list out all of its common potential ingredients.  
-            3. If it's a common food item, like cream cheese, chocolate, etc. Then, just consider them as an ingredient.  
-            4. If multiple distinct food items are clearly visible and separable, list the dominant one or a combined estimate.
-            5. Your Respond should be in json format that have keys called Food_Name and Ingredients where the value for the key Ingredients is an array of strings the ingredient list along with its gram measurement seperated with commas, no unnecessary texts. For example:
-            Milk 100g, Chicken 80g, etc.
-            This is an example of the json file
-             5. The json file should be in the following format:
-            {{
-              "Food_Name": "string",
-              "Ingredients": array_of_ingredients with measurements in grams  
-            }}
-            6.If the image does not contain food, return a JSON with null or 0 values for nutrients put the Food_Name as "Not A Food Item".
-
-            YOU SHOULD RETURN A JSON FILE AND NOTHING ELSE
-        """
-
-        prompt_parts = [prompt, img]
-
-        print(f"Sending prompt to Gemini for patient: {patientid}")
-        gemini_response = text_model.generate_content(
-            prompt_parts
-        )  # Use a different variable name
-        answer1 = gemini_response.text.strip()  # Strip whitespace
-
-        # Clean up potential markdown code blocks
-        answer1 = re.sub(r"^```json\s*", "", answer1, flags=re.MULTILINE)
-        answer1 = re.sub(r"\s*```$", "", answer1, flags=re.MULTILINE)
-        answer1 = answer1.strip()
-
-        print(f"Raw Gemini response text: {answer1}")
-
-        answer1_json = json.loads(answer1)
-
-
-        # Parse the ingredient list
-        ingredients = answer1.split(',')
-        parsed_ingredients = []
-        print(f"Raw Gemini response text: {ingredients}")
-        # Initialize ChromaDB client with existing database
-
-
-        context_rag = ""
-
-        for i in ingredients :
-            results = vectorstore.similarity_search(i,k=1)
-            print(results[0].page_content)
-            
-
-            context_rag += results[0].page_content + "/n"
+        image = await run_blocking("image", prepare_image, contents, file.filename)
+        print(f"Prepared image: {image.size[0]}x{image.size[1]}, {len(image.data)} bytes")
+        upload_task = start_image_upload(image.data, image.filename)
+
+        fingerprint, answer_json = await lookup_analysis("upload-image-rag", image)
+        if answer_json is None:
+            # Enhanced prompt for more robust JSON
+            prompt = """
+                1. Persona: You are nutritionist that help to analyze the food items in the image.
+                2. Identify the dish and list out all of its common potential ingredients.  
+                3. If it's a common food item, like cream cheese, chocolate, etc. Then, just consider them as an ingredient.  
+                4. If multiple distinct food items are clearly visible and separable, list the dominant one or a combined estimate.
+                5. Your Respond should be in json format that have keys called Food_Name and Ingredients where the value for the key Ingredients is an array of strings the ingredient list along with its gram measurement seperated with commas, no unnecessary texts. For example:
+                Milk 100g, Chicken 80g, etc.
+                This is an example of the json file
+                 5. The json file should be in the following format:
+                {
+                  "Food_Name": "string",
+                  "Ingredients": array_of_ingredients with measurements in grams  
+                }
+                6.If the image does not contain food, return a JSON with null or 0 values for nutrients put the Food_Name as "Not A Food Item".
 
-        print(f"Parsed ingredients with matches and nutrition: {context_rag}")
+                YOU SHOULD RETURN A JSON FILE AND NOTHING ELSE
+            """
 
-        final_prompt = f"""
-        1. Given the list of ingredients and their weight measurement, calculate the sum of all nutrient content for the food (calorie, fat, sugars , sodium)
-        2. List of ingredients: {answer1}
-        3. Here are some additional information :
-        {context_rag}
+            prompt_parts = [prompt, image.gemini_part()]
 
-        ONLY USE THIS INFORMATION IF IT IS NECESSARY, IF IT IS NOT NECESSARY DONT USE IT
+            print(f"Sending prompt to Gemini for patient: {patientid}")
+            meal = await generate_structured(prompt_parts, MEAL_INGREDIENTS_SCHEMA, MealIngredients)
+            answer1 = ", ".join(meal.Ingredients)
 
-        4. From the sum of the nutrients content, compile them to a single json file.
-        5. The json file should be in the following format:
-        {{
-              "Food": "string",
-              "calories(kcal)": float_or_int,
-              "fat(g)": float_or_int,
-              "sodium(g)": float_or_int,
-              "sugar(g)": float_or_int
-            }}
-        7. RESPOND ONLY WITH JSON FILE AND NOTHING ELSE
-        """
+            print(f"Gemini ingredients: {meal}")
 
-        
-        gemini_response = text_model.generate_content(
-            final_prompt
-        )  # Use a different variable name
-        answer2 = gemini_response.text.strip()  
+            # Parse the ingredient list
+            ingredients = parse_ingredients(meal.Ingredients)
+            print(f"Parsed ingredients: {ingredients}")
 
-        # Clean up the response by removing markdown code block formatting
-        answer2 = answer2.replace('```json', '').replace('```', '').strip()
+            matches = await run_blocking("chroma", match_ingredients, ingredients)
 
-        try:
-            answer_json = json.loads(answer2)
-        except json.JSONDecodeError as e:
-            print(f"JSONDecodeError: {e}. Gemini response was: {answer2}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"AI model returned invalid JSON. Response: {answer2}",
-            )
-        
+            # Every ingredient confidently matched: add the nutrients up locally
+            answer_json = calculate_meal(meal.Food_Name, ingredients, matches)
+            if answer_json is not None:
+                print(f"Calculated nutrients locally: {answer_json}")
+            else:
+                context_rag = ingredient_context(matches)
+
+                print(f"Parsed ingredients with matches and nutrition: {context_rag}")
+
+                final_prompt = f"""
+                1. Given the list of ingredients and their weight measurement, calculate the sum of all nutrient content for the food (calorie, fat, sugars , sodium)
+                2. List of ingredients: {answer1}
+                3. Here are some additional information :
+                {context_rag}
+
+                ONLY USE THIS INFORMATION IF IT IS NECESSARY, IF IT IS NOT NECESSARY DONT USE IT
+
+                4. From the sum of the nutrients content, compile them to a single json file.
+                5. The json file should be in the following format:
+                {{
+                      "Food": "string",
+                      "calories(kcal)": float_or_int,
+                      "fat(g)": float_or_int,
+                      "sodium(g)": float_or_int,
+                      "sugar(g)": float_or_int
+                    }}
+                7. RESPOND ONLY WITH JSON FILE AND NOTHING ELSE
+                """
+
+                nutrients = await generate_structured(
+                    [final_prompt], MEAL_NUTRIENTS_SCHEMA, MealNutrients
+                )
+                answer_json = nutrients.to_answer()
 
-        print(f"Parsed Gemini JSON: {answer_json}")
+            print(f"Parsed Gemini JSON: {answer_json}")
 
-        # Validate expected keys from Gemini (optional but good practice)
-        expected_keys = ["Food", "calories(kcal)", "fat(g)", "sodium(g)", "sugar(g)"]
-        for key in expected_keys:
-            if key not in answer_json:
-                print(f"Warning: Key '{key}' missing in Gemini response. Using None/0.")
-                # Provide default if a key is missing to avoid KeyError later
-                if "kcal" in key or "(g)" in key:
-                    answer_json[key] = 0  # Default to 0 for numerical values
-                else:
-                    answer_json[key] = "N/A"  # Default for string values
+            remember_analysis("upload-image-rag", fingerprint, answer_json)
 
-        print("Uploading to Imgur...")
-        headers = {"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"}
-        imgur_resp = requests.post(  # Use a different variable name
-            IMGUR_UPLOAD_ENDPOINT, headers=headers, files={"image": contents}
-        )
-        imgur_resp.raise_for_status()  # Will raise an exception for 4XX/5XX status
-        image_link = imgur_resp.json()["data"]["link"]
+        image_link = await upload_task
         answer_json["image_link"] = image_link
         print(f"Imgur link: {image_link}")
 
 
         return answer_json  # This is what React Native receives
 
-    except requests.exceptions.RequestException as e:
-        print(f"Imgur API request error: {e}")
-        raise HTTPException(
-            status_code=503,
-            detail=f"Error communicating with Image Hosting service: {str(e)}",
-        )
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except PIL.UnidentifiedImageError:
         print("Error: Cannot identify image file.")
         raise HTTPException(status_code=400, detail="Invalid or corrupted image file.")
@@ -1306,6 +2328,9 @@ async def upload_image(
                 detail=f"Content blocked by AI: {e.prompt_feedback.block_reason.name}",
             )
         raise HTTPException(status_code=500, detail=f"{str(e)}")
+    finally:
+        if upload_task is not None:
+            upload_task.cancel()  # no-op once it has been awaited
     
 class insert_logs_request(BaseModel):
     patientid:int
@@ -1317,13 +2342,12 @@ class insert_logs_request(BaseModel):
     image_link:str
 
 @app.post("/insert_logs")
-async def insert_logs(req: insert_logs_request):
+@runs_on("firebase")
+def insert_logs(req: insert_logs_request):
     try:
         now = datetime.now()
         dt_string = now.strftime("%Y-%m-%d %H:%M:%S")
 
-        table_ref = db.reference("diet_logs")
-
         new_diet_log = {
             "PatientID": req.patientid,
             "calorie_intake":req.Calorie_kcal ,  # Use .get for safety
@@ -1336,7 +2360,7 @@ async def insert_logs(req: insert_logs_request):
         }
 
         print(f"Saving to Firebase: {new_diet_log}")
-        table_ref.push(new_diet_log)
+        record_diet_log(new_diet_log)
         return {"Status":"Successful"}
     except:
         return {"Status":"Error"}
@@ -1348,136 +2372,97 @@ async def upload_image_Name(
     patientid: int = Form(...),  # MODIFIED: Receive patientid as Form data
     file: UploadFile = File(...),
 ):
+    upload_task = None
     try:
-        load_dotenv(dotenv_path="api_keys.env")
-        IMGUR_CLIENT_ID = os.getenv("IMGUR_CLIENT_ID")
-        IMGUR_UPLOAD_ENDPOINT = "https://api.imgur.com/3/image"
-
-        contents = await file.read()
+        contents = await read_upload(file)
         print(f"Received file size: {len(contents)} bytes")
 
-        img = PIL.Image.open(io.BytesIO(contents))
-
-        # Enhanced prompt for more robust JSON
-        prompt = f"""
-            1. Persona: You are nutritionist that help to analyze the food items in the image.
-            2. Identify the dish and list out all of its common potential ingredients.  
-            3. If it's a common food item, like cream cheese, chocolate, etc. Then, just consider them as an ingredient.  
-
-            4. Respond with ONLY the ingredient list along with its gram measurement seperated with commas, no unnecessary texts. For example:
-            Milk 100g, Chicken 80g, etc.
-
-            5. If multiple distinct food items are clearly visible and separable, list the dominant one or a combined estimate.
-            6. The Name of the food in the picture is {FoodName}
-            7. If the image does not contain food, return a JSON with null or 0 values for nutrients and "Not a food item" for "Food" .
-        """
-
-        prompt_parts = [prompt, img]
-
-        print(f"Sending prompt to Gemini for patient: {patientid}")
-        gemini_response = text_model.generate_content(
-            prompt_parts
-        )  # Use a different variable name
-        answer1 = gemini_response.text.strip()  # Strip whitespace
+        image = await run_blocking("image", prepare_image, contents, file.filename)
+        print(f"Prepared image: {image.size[0]}x{image.size[1]}, {len(image.data)} bytes")
+        upload_task = start_image_upload(image.data, image.filename)
+
+        # The food name is part of the prompt, so it is part of the cache key too
+        cache_namespace = f"upload-image-and-Name:{FoodName.strip().lower()}"
+        fingerprint, answer_json = await lookup_analysis(cache_namespace, image)
+        if answer_json is None:
+            # Enhanced prompt for more robust JSON
+            prompt = f"""
+                1. Persona: You are nutritionist that help to analyze the food items in the image.
+                2. Identify the dish and list out all of its common potential ingredients.  
+                3. If it's a common food item, like cream cheese, chocolate, etc. Then, just consider them as an ingredient.  
+
+                4. Put the food name in Food_Name and every ingredient along with its gram measurement in Ingredients, no unnecessary texts. For example:
+                Milk 100g, Chicken 80g, etc.
+
+                5. If multiple distinct food items are clearly visible and separable, list the dominant one or a combined estimate.
+                6. The Name of the food in the picture is {FoodName}
+                7. If the image does not contain food, put "Not a food item" as Food_Name and leave Ingredients empty.
+            """
 
-        # Clean up potential markdown code blocks
-        answer1 = re.sub(r"^```json\s*", "", answer1, flags=re.MULTILINE)
-        answer1 = re.sub(r"\s*```$", "", answer1, flags=re.MULTILINE)
-        answer1 = answer1.strip()
+            prompt_parts = [prompt, image.gemini_part()]
 
-        print(f"Raw Gemini response text: {answer1}")
-        
+            print(f"Sending prompt to Gemini for patient: {patientid}")
+            meal = await generate_structured(prompt_parts, MEAL_INGREDIENTS_SCHEMA, MealIngredients)
+            answer1 = ", ".join(meal.Ingredients)
 
-        # Parse the ingredient list
-        ingredients = answer1.split(',')
-        parsed_ingredients = []
-        print(f"Raw Gemini response text: {ingredients}")
-        # Initialize ChromaDB client with existing database
+            print(f"Gemini ingredients: {meal}")
 
+            # Parse the ingredient list
+            ingredients = parse_ingredients(meal.Ingredients)
+            print(f"Parsed ingredients: {ingredients}")
 
-        context_rag = ""
+            matches = await run_blocking("chroma", match_ingredients, ingredients)
 
-        for i in ingredients :
-            results = vectorstore.similarity_search(i,k=1)
-            print(results[0].page_content)
-            
-
-            context_rag += results[0].page_content + "/n"
+            # Every ingredient confidently matched: add the nutrients up locally
+            answer_json = calculate_meal(FoodName, ingredients, matches)
+            if answer_json is not None:
+                print(f"Calculated nutrients locally: {answer_json}")
+            else:
+                context_rag = ingredient_context(matches)
 
         
-        print(f"Parsed ingredients with matches and nutrition: {context_rag}")
-
-        final_prompt = f"""
-        1. Given the list of ingredients and their weight measurement, calculate the sum of all nutrient content for the food (calorie, fat, sugars , sodium)
-        2. List of ingredients: {answer1}
-        3. Here are some additional information :
-        {context_rag}
-
-        ONLY USE THIS INFORMATION IF IT IS NECESSARY, IF IT IS NOT NECESSARY DONT USE IT
-
-        4. From the sum of the nutrients content, compile them to a single json file.
-        5. The json file should be in the following format:
-        {{
-              "Food": {FoodName},
-              "calories(kcal)": float_or_int,
-              "fat(g)": float_or_int,
-              "sodium(g)": float_or_int,
-              "sugar(g)": float_or_int
-            }}
-        7. RESPOND ONLY WITH JSON FILE AND NOTHING ELSE
-        """
-
-        gemini_response = text_model.generate_content(
-            final_prompt
-        )  # Use a different variable name
-        answer2 = gemini_response.text.strip()  
-
-        # Clean up the response by removing markdown code block formatting
-        answer2 = answer2.replace('```json', '').replace('```', '').strip()
-
-        try:
-            answer_json = json.loads(answer2)
-        except json.JSONDecodeError as e:
-            print(f"JSONDecodeError: {e}. Gemini response was: {answer2}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"AI model returned invalid JSON. Response: {answer2}",
-            )
+                print(f"Parsed ingredients with matches and nutrition: {context_rag}")
+
+                final_prompt = f"""
+                1. Given the list of ingredients and their weight measurement, calculate the sum of all nutrient content for the food (calorie, fat, sugars , sodium)
+                2. List of ingredients: {answer1}
+                3. Here are some additional information :
+                {context_rag}
+
+                ONLY USE THIS INFORMATION IF IT IS NECESSARY, IF IT IS NOT NECESSARY DONT USE IT
+
+                4. From the sum of the nutrients content, compile them to a single json file.
+                5. The json file should be in the following format:
+                {{
+                      "Food": {FoodName},
+                      "calories(kcal)": float_or_int,
+                      "fat(g)": float_or_int,
+                      "sodium(g)": float_or_int,
+                      "sugar(g)": float_or_int
+                    }}
+                7. RESPOND ONLY WITH JSON FILE AND NOTHING ELSE
+                """
+
+                nutrients = await generate_structured(
+                    [final_prompt], MEAL_NUTRIENTS_SCHEMA, MealNutrients
+                )
+                answer_json = nutrients.to_answer()
         
 
 
-        print(f"Parsed Gemini JSON: {answer_json}")
+            print(f"Parsed Gemini JSON: {answer_json}")
 
-        # Validate expected keys from Gemini (optional but good practice)
-        expected_keys = ["Food", "calories(kcal)", "fat(g)", "sodium(g)", "sugar(g)"]
-        for key in expected_keys:
-            if key not in answer_json:
-                print(f"Warning: Key '{key}' missing in Gemini response. Using None/0.")
-                # Provide default if a key is missing to avoid KeyError later
-                if "kcal" in key or "(g)" in key:
-                    answer_json[key] = 0  # Default to 0 for numerical values
-                else:
-                    answer_json[key] = "N/A"  # Default for string values
+            remember_analysis(cache_namespace, fingerprint, answer_json)
 
-        print("Uploading to Imgur...")
-        headers = {"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"}
-        imgur_resp = requests.post(  # Use a different variable name
-            IMGUR_UPLOAD_ENDPOINT, headers=headers, files={"image": contents}
-        )
-        imgur_resp.raise_for_status()  # Will raise an exception for 4XX/5XX status
-        image_link = imgur_resp.json()["data"]["link"]
+        image_link = await upload_task
         answer_json["image_link"] = image_link
         print(f"Imgur link: {image_link}")
 
 
         return answer_json  # This is what React Native receives
 
-    except requests.exceptions.RequestException as e:
-        print(f"Imgur API request error: {e}")
-        raise HTTPException(
-            status_code=503,
-            detail=f"Error communicating with Image Hosting service: {str(e)}",
-        )
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except PIL.UnidentifiedImageError:
         print("Error: Cannot identify image file.")
         raise HTTPException(status_code=400, detail="Invalid or corrupted image file.")
@@ -1496,20 +2481,25 @@ async def upload_image_Name(
                 detail=f"Content blocked by AI: {e.prompt_feedback.block_reason.name}",
             )
         raise HTTPException(status_code=500, detail=f"{str(e)}")
+    finally:
+        if upload_task is not None:
+            upload_task.cancel()  # no-op once it has been awaited
     
 
 @app.post("/upload_image_and_ask", response_model=ImageAIResponse)
 async def upload_image_and_ask(prompt: str, file: UploadFile = File(...)):
     try:
         print(f"Received image: {file.filename}, prompt: {prompt}")
-        contents = await file.read()
+        contents = await read_upload(file)
 
         # Prepare image for Gemini Vision
-        img = PIL.Image.open(io.BytesIO(contents))
+        image = await run_blocking("image", prepare_image, contents, file.filename)
 
-        prompt_parts = [prompt, img]
+        prompt_parts = [prompt, image.gemini_part()]
 
-        response = text_model.generate_content(
+        response = await run_blocking(
+            "gemini",
+            gemini_generate,
             prompt_parts,
             generation_config={
                 "response_mime_type": "application/json",
@@ -1518,6 +2508,8 @@ async def upload_image_and_ask(prompt: str, file: UploadFile = File(...)):
 
         print(f"Gemini vision response: {response.text}")
         return ImageAIResponse(message=response.text, original_filename=file.filename)
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         print(f"Error during image processing: {e}")
         if hasattr(e, "prompt_feedback") and e.prompt_feedback.block_reason:
@@ -1530,16 +2522,25 @@ async def upload_image_and_ask(prompt: str, file: UploadFile = File(...)):
 
 # --- (Optional) Endpoint to reset chat history ---
 @app.post("/reset-chat")
-async def reset_chat_history():
-    global chat_session
-    chat_session = text_model.start_chat(history=[])
+async def reset_chat_history(patientid: Optional[int] = Query(None)):
+    # Without a patientid every patient's session is reset, as before
+    chat_sessions.reset(patientid)
+    return {"message": "Chat history has been reset."}
+
+
+@app.post("/reset-chat-dr")
+async def reset_chat_dr_history(dr_id: int = Query(...), session_id: Optional[str] = Query(None)):
+    # Not inline: clear waits for a summary add_turn may be writing, and that
+    # runs on the gemini pool too
+    await run_blocking("gemini", chat_memory.clear, chat_memory.key(dr_id, session_id))
     return {"message": "Chat history has been reset."}
 
 
 @app.get("/get-data")
-async def get_data():
+@runs_on("firebase")
+def get_data():
     try:
-        patient_ref = db.reference("patient_intake")
+        patient_ref = get_reference("patient_intake")
 
         all_intakes = patient_ref.get()
 
@@ -1552,18 +2553,11 @@ async def get_data():
 
 
 @app.post("/login_patient")
-async def login_patient(req: LoginRequest):
+@runs_on("firebase")
+def login_patient(req: LoginRequest):
 
     # 3a) Fetch patient_table
-    table_ref = db.reference("patient_table")
-    raw = table_ref.get()
-
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
+    records = load_records("patient_table")
 
     # 3) Turn into DataFrame
     df = pd.DataFrame(records)
@@ -1587,16 +2581,9 @@ class SignUpPatient(BaseModel):
 
 
 @app.post("/signup_pat")
-async def signup_pat(req: SignUpPatient):
-    table_ref = db.reference("patient_table")
-    raw = table_ref.get()
-
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
+@runs_on("firebase")
+def signup_pat(req: SignUpPatient):
+    records = load_records("patient_table")
 
     # 3) Turn into DataFrame
     df = pd.DataFrame(records)
@@ -1617,45 +2604,30 @@ async def signup_pat(req: SignUpPatient):
         "patient_status": "",
     }
 
-    table_ref.push(new_pat)
+    push_record("patient_table", new_pat)
     return {"success": True, "message": "Patient registered successfully!", "patientId": pat_id}
 
 
 
 
 @app.get("/get_today_diet_log")
-async def get_today_diet_log(patientid: int = Query(...)):
-    # 1) Fetch raw logs
-    raw = db.reference("diet_logs").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-
-    # 2) Build DataFrame and filter by patient
-    df = pd.DataFrame(records)
-    df = df[df["PatientID"] == patientid]
-
-    # 3) Today's date
+@runs_on("firebase")
+def get_today_diet_log(patientid: int = Query(...)):
+    # 1) Today's date
     now = datetime.now()
     todays_date = now.date()
 
-    # 4) Convert and extract date column
-    df["datetime"] = pd.to_datetime(df["datetime"], errors="coerce")
-    df["date"] = df["datetime"].dt.date
-
-    # 5) Filter to only today's entries
+    # 2) Today's row of the daily rollup
+    df = load_daily_rollup(patientid)
     today_df = df[df["date"] == todays_date]
 
-    # 6) Sum totals (coerce NaN to 0)
+    # 3) Sum totals (coerce NaN to 0)
     total_calorie = int(today_df["calorie_intake"].sum() or 0)
     total_fat = float(today_df["fat_intake"].sum() or 0.0)
     total_sodium = float(today_df["sodium_intake"].sum() or 0.0)
     total_sugar = float(today_df["sugar_intake"].sum() or 0.0)
 
-    # 7) Return as JSON
+    # 4) Return as JSON
     return {
         "patientid": patientid,
         "date": str(todays_date),
@@ -1666,16 +2638,23 @@ async def get_today_diet_log(patientid: int = Query(...)):
     }
 
 
-@app.get("/get_patient_by_id")
-async def get_patient_by_id(id: int = Query(...)):
-    raw = db.reference("patient_table").get()
+@app.post("/rebuild_nutrient_rollup")
+@runs_on("firebase")
+def rebuild_rollup(patientid: Optional[int] = Query(None)):
+    """Recompute the daily nutrient rollup from diet_logs (one patient or all)."""
+    try:
+        if patientid is not None:
+            rebuild_patient_rollup(patientid, force=True)
+            return {"success": True, "patients": 1}
+        return {"success": True, "patients": rebuild_nutrient_rollup()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Firebase error: {e}")
 
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
+
+@app.get("/get_patient_by_id")
+@runs_on("firebase")
+def get_patient_by_id(id: int = Query(...)):
+    records = load_records("patient_table")
 
     df = pd.DataFrame(records)
     df=df[df["PatientID"]==id]
@@ -1683,46 +2662,7 @@ async def get_patient_by_id(id: int = Query(...)):
 
     df2=df.copy()
 
-    latest_log_arr = []
-    for i in range (len(df2)):
-        patient_id = df2.iloc[i]["PatientID"]
-        diet_log = db.reference('diet_logs')
-        raw = diet_log.get()
-        # 2) Normalize into a list of dicts
-        if isinstance(raw, dict):
-            records = list(raw.values())
-        elif isinstance(raw, list):
-            records = raw
-        else:
-            records = []
-
-        # 3) Turn into DataFrame
-        df_dietlog = pd.DataFrame(records)
-        df_dietlog = df_dietlog[df_dietlog["PatientID"]==patient_id]
-        df_dietlog["datetime"]= pd.to_datetime(df_dietlog["datetime"])
-        latest_log_diet  = df_dietlog["datetime"].max()
-
-        exercise_log = db.reference('exercise')
-        raw = exercise_log.get()
-        # 2) Normalize into a list of dicts
-        if isinstance(raw, dict):
-            records = list(raw.values())
-        elif isinstance(raw, list):
-            records = raw
-        else:
-            records = []
-
-        df_exerciselog = pd.DataFrame(records)
-        df_exerciselog = df_exerciselog[df_exerciselog["PatientID"]==patient_id]
-        df_exerciselog["Datetime"]= pd.to_datetime(df_exerciselog["Datetime"])
-        latest_log_exercise  = df_exerciselog["Datetime"].max()
-
-        if(latest_log_diet>latest_log_exercise):
-            latest_log_arr.append(latest_log_diet)
-        else:
-            latest_log_arr.append(latest_log_diet) 
-
-    df2["Last Activity"]=latest_log_arr
+    df2 = with_last_activity(df2, "Last Activity")
 
 
     if df2.empty:
@@ -1755,16 +2695,9 @@ def estimate_distance_km(steps: int) -> float:
     return round(max(distance_km, 0), 3)
 
 @app.get("/get_steps_phone")
-async def get_steps_phone(patientid: int = Query(...)):
-    raw = db.reference("steps_table").get()
-    if isinstance(raw, dict):
-        records = list(raw.values())
-    elif isinstance(raw, list):
-        records = raw
-    else:
-        records = []
-    df = pd.DataFrame(records)
-    df = df[df["PatientID"] == patientid]
+@runs_on("firebase")
+def get_steps_phone(patientid: int = Query(...)):
+    df = load_patient_frame("steps_table", patientid)
     df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
     df['day'] = df['Date'].dt.day_name()
     
@@ -0,0 +1,383 @@
+# In-memory stand-in for the Firebase Realtime Database.
+#
+# Implements the subset of the firebase_admin.db Reference/Query API that the
+# backend uses (get, set, push, update, delete, transaction, child, listen and ordered
+# queries with equal_to / start_at / end_at / limit_to_*), with the same
+# ordering rules as the realtime database. Ordered queries are checked against
+# the ".indexOn" entries of a rules file, like the real server does, so a query
+# that works here also has the index it needs in production.
+#
+# Select it with FIREBASE_BACKEND=memory (see main.py) to run and benchmark the
+# API offline, optionally seeded from a JSON export of the database.
+
+import copy
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+
+class MemoryDatabaseError(ValueError):
+    pass
+
+
+class Event:
+    """Same shape as firebase_admin.db.Event."""
+
+    def __init__(self, event_type: str, path: str, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+
+class ListenerRegistration:
+    def __init__(self, database: "InMemoryDatabase", path: str, callback: Callable):
+        self._database = database
+        self.path = path
+        self.callback = callback
+
+    def close(self):
+        self._database._remove_listener(self)
+
+
+def split_path(path: str) -> List[str]:
+    return [p for p in (path or "").split("/") if p]
+
+
+def join_path(parts: List[str]) -> str:
+    return "/" + "/".join(parts)
+
+
+def _sort_rank(value):
+    """Realtime database ordering: null, false, true, numbers, strings, objects."""
+    if value is None:
+        return (0, 0)
+    if value is False:
+        return (1, 0)
+    if value is True:
+        return (2, 0)
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value)
+    return (5, 0)
+
+
+def _key_rank(key: str):
+    # Keys that look like 32-bit ints sort numerically before string keys
+    try:
+        return (0, int(key), "")
+    except ValueError:
+        return (1, 0, key)
+
+
+def _children(value) -> Dict[str, Any]:
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, list):
+        return {str(i): v for i, v in enumerate(value) if v is not None}
+    return {}
+
+
+class InMemoryDatabase:
+    def __init__(self, data=None, rules=None):
+        self._root: Dict[str, Any] = copy.deepcopy(data) if isinstance(data, dict) else {}
+        self._rules = rules
+        self._listeners: List[ListenerRegistration] = []
+        self._lock = threading.RLock()
+        self._last_push_time = 0
+        self._last_rand: List[int] = []
+
+    @classmethod
+    def from_files(cls, data_path: Optional[str] = None, rules_path: Optional[str] = None):
+        data = None
+        rules = None
+        if data_path:
+            with open(data_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        if rules_path:
+            with open(rules_path, "r", encoding="utf-8") as f:
+                rules = json.load(f).get("rules", {})
+        return cls(data, rules)
+
+    def reference(self, path: str = "/") -> "Reference":
+        return Reference(self, split_path(path))
+
+    # ---- storage ----
+    def _read(self, parts: List[str]):
+        node = self._root
+        for part in parts:
+            node = _children(node).get(part)
+            if node is None:
+                return None
+        return node
+
+    def _write(self, parts: List[str], value):
+        if not parts:
+            self._root = value if isinstance(value, dict) else {}
+            return
+        node = self._root
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                child = _children(child).copy() if child is not None else {}
+                node[part] = child
+            node = child
+        if value is None or value == {}:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+        self._prune(parts[:-1])
+
+    def _prune(self, parts: List[str]):
+        # Empty parents disappear, as they do in the realtime database
+        while parts:
+            if self._read(parts) not in ({}, None):
+                return
+            parent = self._read(parts[:-1]) if len(parts) > 1 else self._root
+            parent.pop(parts[-1], None)
+            parts = parts[:-1]
+
+    def _push_key(self) -> str:
+        now = int(time.time() * 1000)
+        duplicate = now == self._last_push_time
+        self._last_push_time = now
+
+        chars = []
+        for _ in range(8):
+            chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+        key = "".join(reversed(chars))
+
+        if not duplicate:
+            self._last_rand = [random.randrange(64) for _ in range(12)]
+        else:
+            # Same millisecond: increment the random part so keys stay ordered
+            i = 11
+            while i >= 0 and self._last_rand[i] == 63:
+                self._last_rand[i] = 0
+                i -= 1
+            if i >= 0:
+                self._last_rand[i] += 1
+        return key + "".join(PUSH_CHARS[r] for r in self._last_rand)
+
+    # ---- rules ----
+    def check_index(self, parts: List[str], child: str):
+        if self._rules is None:
+            return
+        node = self._rules
+        for part in parts:
+            if part in node:
+                node = node[part]
+            else:
+                wildcard = next((k for k in node if k.startswith("$")), None)
+                node = node.get(wildcard, {}) if wildcard else {}
+        index_on = node.get(".indexOn", [])
+        if isinstance(index_on, str):
+            index_on = [index_on]
+        if child not in index_on:
+            raise MemoryDatabaseError(
+                f'Index not defined, add ".indexOn": "{child}", '
+                f'for path "{join_path(parts)}", to the rules'
+            )
+
+    # ---- listeners ----
+    def _add_listener(self, parts: List[str], callback: Callable) -> ListenerRegistration:
+        registration = ListenerRegistration(self, join_path(parts), callback)
+        with self._lock:
+            self._listeners.append(registration)
+            snapshot = copy.deepcopy(self._read(parts))
+        callback(Event("put", "/", snapshot))
+        return registration
+
+    def _remove_listener(self, registration: ListenerRegistration):
+        with self._lock:
+            if registration in self._listeners:
+                self._listeners.remove(registration)
+
+    def _notify(self, parts: List[str], event_type: str, data):
+        for registration in list(self._listeners):
+            listen_parts = split_path(registration.path)
+            if parts[:len(listen_parts)] == listen_parts:
+                # write at or below the listener
+                event = Event(event_type, join_path(parts[len(listen_parts):]), copy.deepcopy(data))
+            elif listen_parts[:len(parts)] == parts:
+                # write above the listener replaces everything it watches
+                event = Event("put", "/", copy.deepcopy(self._read(listen_parts)))
+            else:
+                continue
+            try:
+                registration.callback(event)
+            except Exception as e:
+                print(f"memory_db: listener on {registration.path} failed: {e}")
+
+
+class Reference:
+    def __init__(self, database: InMemoryDatabase, parts: List[str]):
+        self._db = database
+        self._parts = parts
+
+    @property
+    def key(self) -> Optional[str]:
+        return self._parts[-1] if self._parts else None
+
+    @property
+    def path(self) -> str:
+        return join_path(self._parts)
+
+    def child(self, path: str) -> "Reference":
+        return Reference(self._db, self._parts + split_path(path))
+
+    def get(self, etag: bool = False, shallow: bool = False):
+        with self._db._lock:
+            value = copy.deepcopy(self._db._read(self._parts))
+        if shallow and isinstance(value, dict):
+            value = {k: True for k in value}
+        if etag:
+            return value, _etag(value)
+        return value
+
+    def get_if_changed(self, etag: str):
+        value, new_etag = self.get(etag=True)
+        if new_etag == etag:
+            return False, None, None
+        return True, value, new_etag
+
+    def set(self, value):
+        with self._db._lock:
+            self._db._write(self._parts, copy.deepcopy(value))
+            self._db._notify(self._parts, "put", value)
+
+    def push(self, value="") -> "Reference":
+        with self._db._lock:
+            ref = self.child(self._db._push_key())
+            if value != "":
+                ref.set(value)
+        return ref
+
+    def update(self, value: Dict[str, Any]):
+        if not isinstance(value, dict) or not value:
+            raise ValueError("Value argument must be a non-empty dictionary.")
+        with self._db._lock:
+            for path, child_value in value.items():
+                self._db._write(self._parts + split_path(path), copy.deepcopy(child_value))
+            self._db._notify(self._parts, "patch", value)
+
+    def delete(self):
+        self.set(None)
+
+    def transaction(self, transaction_update: Callable):
+        # A single lock makes every transaction succeed on the first attempt
+        with self._db._lock:
+            current = copy.deepcopy(self._db._read(self._parts))
+            new_value = transaction_update(current)
+            self.set(new_value)
+        return new_value
+
+    def listen(self, callback: Callable) -> ListenerRegistration:
+        return self._db._add_listener(self._parts, callback)
+
+    def order_by_child(self, path: str) -> "Query":
+        if not path or path.startswith("$"):
+            raise ValueError(f"Illegal child path: {path}")
+        self._db.check_index(self._parts, path)
+        return Query(self, order_by=("child", split_path(path)))
+
+    def order_by_key(self) -> "Query":
+        return Query(self, order_by=("key", None))
+
+    def order_by_value(self) -> "Query":
+        self._db.check_index(self._parts, ".value")
+        return Query(self, order_by=("value", None))
+
+
+class Query:
+    def __init__(self, ref: Reference, order_by):
+        self._ref = ref
+        self._order_by = order_by
+        self._start = None
+        self._end = None
+        self._equal = None
+        self._limit_first = None
+        self._limit_last = None
+
+    def start_at(self, start) -> "Query":
+        if start is None:
+            raise ValueError("Start value must not be None.")
+        self._start = start
+        return self
+
+    def end_at(self, end) -> "Query":
+        if end is None:
+            raise ValueError("End value must not be None.")
+        self._end = end
+        return self
+
+    def equal_to(self, value) -> "Query":
+        if value is None:
+            raise ValueError("Equal to value must not be None.")
+        if self._start is not None or self._end is not None:
+            raise ValueError("Cannot set both equal_to and a range.")
+        self._equal = value
+        return self
+
+    def limit_to_first(self, limit: int) -> "Query":
+        if self._limit_last is not None:
+            raise ValueError("Cannot set both first and last limits.")
+        self._limit_first = limit
+        return self
+
+    def limit_to_last(self, limit: int) -> "Query":
+        if self._limit_first is not None:
+            raise ValueError("Cannot set both first and last limits.")
+        self._limit_last = limit
+        return self
+
+    def _sort_value(self, key: str, value):
+        kind, child_parts = self._order_by
+        if kind == "key":
+            return _key_rank(key)
+        if kind == "value":
+            return _sort_rank(value)
+        node = value
+        for part in child_parts:
+            node = _children(node).get(part)
+            if node is None:
+                break
+        return _sort_rank(node)
+
+    def _bound(self, value):
+        return _key_rank(str(value)) if self._order_by[0] == "key" else _sort_rank(value)
+
+    def get(self) -> "OrderedDict[str, Any]":
+        children = _children(self._ref.get())
+        items = sorted(
+            ((self._sort_value(k, v), _key_rank(k), k, v) for k, v in children.items()),
+            key=lambda item: (item[0], item[1]),
+        )
+
+        if self._equal is not None:
+            target = self._bound(self._equal)
+            items = [item for item in items if item[0] == target]
+        if self._start is not None:
+            low = self._bound(self._start)
+            items = [item for item in items if item[0] >= low]
+        if self._end is not None:
+            high = self._bound(self._end)
+            items = [item for item in items if item[0] <= high]
+
+        if self._limit_first is not None:
+            items = items[:self._limit_first]
+        if self._limit_last is not None:
+            items = items[-self._limit_last:]
+        return OrderedDict((k, v) for _, _, k, v in items)
+
+
+def _etag(value) -> str:
+    payload = json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()
@@ -0,0 +1,101 @@
+# Local nutrient calculator for meal photos.
+#
+# food_facts documents carry their nutrient content per 100 g as metadata
+# (see index_food_facts.py). Given Gemini's ingredient list ("Rice 150g, ...")
+# and the matched document for each ingredient, the meal's totals are
+# grams / 100 x per-100g values, summed. That replaces a second Gemini call
+# whenever every ingredient has a quantity and a confident match; otherwise
+# calculate_totals() returns None and the caller asks the LLM as before.
+
+import re
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+# metadata key on a food_facts document -> key in the meal JSON returned to the app
+PER_100G_FIELDS = {
+    "kcal_per_100g": "calories(kcal)",
+    "fat_g_per_100g": "fat(g)",
+    "sodium_g_per_100g": "sodium(g)",
+    "sugar_g_per_100g": "sugar(g)",
+}
+
+# Grams per unit. Millilitres are counted as grams, which is close enough for
+# the drinks, sauces and soups this is used for.
+GRAMS_PER_UNIT = {
+    "mg": 0.001,
+    "g": 1.0, "gr": 1.0, "gram": 1.0, "grams": 1.0,
+    "kg": 1000.0,
+    "ml": 1.0,
+    "l": 1000.0, "litre": 1000.0, "liter": 1000.0,
+    "oz": 28.35,
+}
+QUANTITY = re.compile(
+    r"(\d+(?:[.,]\d+)*)\s*(" + "|".join(sorted(GRAMS_PER_UNIT, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE,
+)
+THOUSANDS_COMMA = re.compile(r",\d{3}(?!\d)")
+
+
+def parse_number(text: str) -> Optional[float]:
+    """A number that may use a decimal comma ("2,5" -> 2.5), or None when it
+    can't be read safely: a comma followed by exactly three digits may be a
+    thousands separator ("1,000")."""
+    if THOUSANDS_COMMA.search(text):
+        return None
+    try:
+        return float(text.replace(",", "."))
+    except ValueError:
+        return None
+
+
+def parse_grams(ingredient: str) -> Optional[float]:
+    """Weight in grams from an ingredient string ("Chicken 80g" -> 80.0), or
+    None if it has no quantity with a weight or volume unit, or the quantity
+    is ambiguous (see parse_number)."""
+    match = QUANTITY.search(ingredient)
+    if match is None:
+        return None
+    amount = parse_number(match.group(1))
+    if amount is None:
+        return None
+    return amount * GRAMS_PER_UNIT[match.group(2).lower()]
+
+
+def per_100g(metadata: Optional[Dict[str, Any]]) -> Optional[List[float]]:
+    """The document's per-100g values in PER_100G_FIELDS order, if it has all of them."""
+    if not metadata:
+        return None
+    try:
+        return [float(metadata[key]) for key in PER_100G_FIELDS]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def calculate_totals(
+    ingredients: Sequence[str],
+    matches: Sequence[Optional[tuple]],
+    max_distance: float,
+) -> Optional[Dict[str, float]]:
+    """Nutrient totals for a meal, or None if any ingredient lacks a quantity,
+    a match within `max_distance` or per-100g metadata on its match.
+
+    `matches` is aligned with `ingredients`; each is (document, distance, metadata)."""
+    if not ingredients:
+        return None
+
+    grams = []
+    values = []
+    for ingredient, match in zip(ingredients, matches):
+        if match is None:
+            return None
+        _, distance, metadata = match
+        weight = parse_grams(ingredient)
+        nutrients = per_100g(metadata)
+        if weight is None or nutrients is None or distance is None or distance > max_distance:
+            return None
+        grams.append(weight)
+        values.append(nutrients)
+
+    totals = np.asarray(grams) @ np.asarray(values) / 100.0
+    return {key: round(float(total), 2) for key, total in zip(PER_100G_FIELDS.values(), totals)}
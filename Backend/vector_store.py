@@ -0,0 +1,119 @@
+# Startup helpers for the food_facts Chroma store.
+#
+# The store ships as chroma_store.zip. ensure_extracted() unpacks it only when
+# the directory does not already hold that exact archive: a manifest written
+# next to the extracted files records the archive's size, mtime and sha256, so
+# an unchanged archive costs one stat() on restart (and a hash only if it was
+# touched). Extraction happens in a temporary directory that is swapped in
+# afterwards, under an exclusive file lock, so several workers starting at
+# once extract it a single time and never see a half-written store.
+
+import hashlib
+import json
+import os
+import shutil
+import zipfile
+from contextlib import contextmanager
+
+MANIFEST_NAME = ".extracted.json"
+
+try:
+    import fcntl
+
+    def _lock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+except ImportError:  # Windows
+    import msvcrt
+
+    def _lock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+    def _unlock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(path: str):
+    with open(path, "a+b") as f:
+        _lock_file(f)
+        try:
+            yield
+        finally:
+            _unlock_file(f)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_manifest(target_dir: str):
+    try:
+        with open(os.path.join(target_dir, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(target_dir: str, manifest):
+    path = os.path.join(target_dir, MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def _is_current(zip_path: str, target_dir: str, stat) -> bool:
+    manifest = _read_manifest(target_dir)
+    if manifest is None:
+        return False
+    if manifest.get("size") == stat.st_size and manifest.get("mtime") == stat.st_mtime:
+        return True
+    # Same size but touched (e.g. re-copied on deploy): compare contents
+    if manifest.get("size") == stat.st_size and manifest.get("sha256") == file_sha256(zip_path):
+        manifest["mtime"] = stat.st_mtime
+        _write_manifest(target_dir, manifest)
+        return True
+    return False
+
+
+def ensure_extracted(zip_path: str, target_dir: str) -> bool:
+    """Make target_dir hold the contents of zip_path. Returns True if it had to
+    extract. Without the archive, an existing target_dir is used as it is."""
+    if not os.path.exists(zip_path):
+        if os.path.isdir(target_dir):
+            return False
+        raise FileNotFoundError(f"Neither {zip_path} nor {target_dir} exists")
+
+    stat = os.stat(zip_path)
+    if _is_current(zip_path, target_dir, stat):
+        return False
+
+    with file_lock(target_dir.rstrip("/\\") + ".lock"):
+        # Another worker may have finished extracting while we waited
+        if _is_current(zip_path, target_dir, stat):
+            return False
+
+        tmp_dir = f"{target_dir}.tmp-{os.getpid()}"
+        old_dir = f"{target_dir}.old-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            zip_ref.extractall(tmp_dir)
+        _write_manifest(tmp_dir, {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": file_sha256(zip_path),
+        })
+
+        if os.path.exists(target_dir):
+            os.replace(target_dir, old_dir)
+        os.replace(tmp_dir, target_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return True
@@ -33,22 +33,22 @@ export default function DashboardPage() {
       setNumberOfPatients(validPatientIDs?.length || 0);// Update the state with number of patients
       const drId = doctorDataObject.DrID;
       
-      getPatientById(drId);
-      getTotalEntries(drId);
-      getLatestEntries(drId);
+      getDashboardSummary(drId);
     }
   }, []);
 
-  async function getPatientById(id: string) {
+  async function getDashboardSummary(id: string) {
     try {
-      const res = await fetch(`http://127.0.0.1:8000/get_patient_dr?drid=${id}`, {
+      // Totals, latest logs and roster in one round trip
+      const res = await fetch(`http://127.0.0.1:8000/get_dr_dashboard_summary?drid=${id}`, {
         cache: "no-store", // ensures fresh fetch every time
       });
 
       if (!res.ok) return null;
 
-      const patientList = await res.json();
-      
+      const data = await res.json();
+
+      const patientList = data.patients;
       setPatientsData(patientList); // Save the patients data in the state
 
       // Filter patients who need attention (urgent or warning status)
@@ -56,40 +56,13 @@ export default function DashboardPage() {
         (patient: any) => patient.patient_status === "urgent" || patient.patient_status === "warning"
       );
       setNumberOfPatientsNeedingAttention(patientsNeedingAttention.length);
-    } catch (err) {
-      return null;
-    }
-  }
 
-  async function getTotalEntries(id: string) {
-    try {
-      const res = await fetch(`http://127.0.0.1:8000/get_total_log_entries?drid=${id}`, {
-        cache: "no-store", // ensures fresh fetch every time
-      });
+      setTotalEntries(data["Total Log Entries"]);
 
-      if (!res.ok) return null;
-
-      const data = await res.json();
-      const total = data["Total Log Entries"];
-      setTotalEntries(total); // Save the patients data in the state
-    } catch (err) {
-      return null;
-    }
-  }
-
-  async function getLatestEntries(id: string) {
-    try {
-      const res = await fetch(`http://127.0.0.1:8000/get_latest_log_entries?drid=${id}`, {
-        cache: "no-store", // ensures fresh fetch every time
-      });
-
-      if (!res.ok) return null;
-
-      const data = await res.json();
-     
-      data.sort((a: any, b: any) => new Date(b.datetime).getTime() - new Date(a.datetime).getTime());
+      const latest = data.latest_logs;
+      latest.sort((a: any, b: any) => new Date(b.datetime).getTime() - new Date(a.datetime).getTime());
 
-      const formatted = data.map((entry: any) => ({
+      const formatted = latest.map((entry: any) => ({
         name: entry.PatientName,
         datetime: new Date(entry.datetime),
       }));